@@ -1,32 +1,110 @@
 import os
-import uuid
+import sys
 import math
+import random
+import secrets
+import threading
 import time
+import queue
+import atexit
 import logging
+import logging.handlers
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dt_time
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 from decimal import Decimal
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 
-import pandas as pd
+import numpy as np
 
 from tinkoff.invest import (
     Client,
+    CandleInstrument,
     CandleInterval,
     InstrumentIdType,
+    OperationState,
+    OrderExecutionReportStatus,
     OrderDirection,
     OrderType,
+    PriceType,
     Quotation,
+    ReplaceOrderRequest,
     RequestError,
+    SubscriptionInterval,
 )
-from tinkoff.invest.utils import now, quotation_to_decimal, decimal_to_quotation
+from tinkoff.invest.utils import now, quotation_to_decimal
 
 from state import BotState
-from journal import TradeJournal
+from journal import BufferedJournal
+from candles import Candles, CandleBuffer
 
 
-@dataclass
+_FINAL_STATUSES = frozenset(
+    (
+        OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL,
+        OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_REJECTED,
+        OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_CANCELLED,
+    )
+)
+
+# API limit for one GetCandles request with 1m interval
+_MAX_1M_CANDLES_WINDOW_MIN = 1440
+# calc_day_cashflow re-reads this much before its cursor: ops can be booked with an earlier date
+_CASHFLOW_OVERLAP = timedelta(minutes=5)
+
+
+def _q_to_float(q) -> float:
+    # Quotation / MoneyValue -> float without the Decimal round-trip
+    return q.units + q.nano * 1e-9
+
+
+@lru_cache(maxsize=16)
+def _tz(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
+
+
+_UTC_TZ = _tz("UTC")
+_MSK_TZ = _tz("Europe/Moscow")  # day window for calc_day_cashflow
+
+def _configure_logging(cfg: dict) -> logging.Logger:
+    """
+    One-time setup of the "bot" logger: file + (optional) console.
+    Re-creating Broker must not stack duplicate handlers.
+    """
+    logger = logging.getLogger("bot")
+    if logger.handlers:
+        return logger
+
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    log_path = cfg.get("log_file", "logs/bot.log")
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    fh = logging.FileHandler(log_path, encoding="utf-8")
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    sinks: List[logging.Handler] = [fh]
+
+    # console mirror (раньше был print() в log())
+    if bool(cfg.get("console_log", True)):
+        sh = logging.StreamHandler(sys.stdout)
+        sh.setLevel(logging.INFO)
+        sh.setFormatter(logging.Formatter("%(message)s"))
+        sinks.append(sh)
+
+    # trading thread only enqueues; file/console writes happen on the listener thread
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    listener = logging.handlers.QueueListener(q, *sinks, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # drain the queue on exit
+
+    return logger
+
+
+@dataclass(slots=True, frozen=True)
 class InstrumentInfo:
     ticker: str
     figi: str
@@ -34,6 +112,22 @@ class InstrumentInfo:
     min_price_increment: float
 
 
+@dataclass(slots=True)
+class _PendingOrder:
+    figi: str
+    side: str  # "BUY" / "SELL"
+    lots: int
+    price: float
+    client_uid: str
+    est_cost: float = 0.0
+    replace_oid: Optional[str] = None  # set -> ReplaceOrder on this working order instead of PostOrder
+    # replaced order's uid / placed_ts: restored if the replace fails (the old order still works)
+    prev_uid: Optional[str] = None
+    prev_placed_ts: Optional[datetime] = None
+    # replace failed and the old order was cancelled instead (then posted as a plain order)
+    cancelled_oid: Optional[str] = None
+
+
 class Broker:
     """
     Broker wrapper for T-Invest with:
@@ -54,39 +148,110 @@ class Broker:
         self._last_low_cash_warn: Dict[str, float] = {}
         self._reserved_rub_by_figi: Dict[str, float] = {}
 
-        os.makedirs("logs", exist_ok=True)
-
-        self.logger = logging.getLogger("bot")
-        self.logger.setLevel(logging.INFO)
-        self.logger.handlers.clear()
-        log_path = cfg.get("log_file", "logs/bot.log")
-        fh = logging.FileHandler(log_path, encoding="utf-8")
-        fh.setLevel(logging.INFO)
-        fh.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-        self.logger.addHandler(fh)
-        self.logger.propagate = False
+        self.logger = _configure_logging(cfg)
 
         self.currency = cfg.get("currency", "rub")
         self.use_sandbox = bool(cfg.get("use_sandbox", True))
         self.class_code = cfg.get("class_code", "TQBR")
 
+        # sandbox/real routing resolved once (bound methods)
+        if self.use_sandbox:
+            sb = self.client.sandbox
+            self._fn_positions = sb.get_sandbox_positions
+            self._fn_orders = sb.get_sandbox_orders
+            self._fn_post_order = sb.post_sandbox_order
+            self._fn_cancel_order = sb.cancel_sandbox_order
+            # older SDK builds have no sandbox ReplaceOrder -> cancel + post fallback
+            self._fn_replace_order = getattr(sb, "replace_sandbox_order", None)
+            self._fn_order_state = sb.get_sandbox_order_state
+            self._fn_operations = sb.get_sandbox_operations
+        else:
+            self._fn_positions = self.client.operations.get_positions
+            self._fn_orders = self.client.orders.get_orders
+            self._fn_post_order = self.client.orders.post_order
+            self._fn_cancel_order = self.client.orders.cancel_order
+            self._fn_replace_order = self.client.orders.replace_order
+            self._fn_order_state = self.client.orders.get_order_state
+            self._fn_operations = self.client.operations.get_operations
+
         self._retry_tries = int(cfg.get("retry_tries", 3))
         self._retry_sleep_min = float(cfg.get("retry_sleep_min", 1.0))
         self._retry_sleep_max = float(cfg.get("retry_sleep_max", 10.0))
 
+        # parallel share_by lookups on startup (keep small: API rate limits)
+        self._resolve_workers = max(1, int(cfg.get("resolve_workers", 8)))
+        # per-FIGI fan-out of blocking API calls (candles, flatten); one pool for the process
+        self._io_workers = max(1, int(cfg.get("io_workers", 8)))
+        self._io_pool = ThreadPoolExecutor(max_workers=self._io_workers, thread_name_prefix="broker-io")
+
+        # instrument metadata is static intraday: ticker -> (monotonic ts, info)
+        self._instr_ttl_s = float(cfg.get("instr_ttl_s", 86400))
+        self._instr_cache: Dict[str, Tuple[float, InstrumentInfo]] = {}
+
         # NEW: how close to last we want to place limit orders (ticks)
         self.buy_aggressive_ticks = int(cfg.get("buy_aggressive_ticks", 1))
         self.sell_aggressive_ticks = int(cfg.get("sell_aggressive_ticks", 1))
 
         self._figi_info: Dict[str, InstrumentInfo] = {}
+        self._account_id: Optional[str] = None
+        self._day_key = ""
+        # last applied snapshot (remote positions/orders, local per-figi view) for idle short-circuit
+        self._snapshot_sig: Optional[Tuple[Any, ...]] = None
+        self._snapshot_local_sig: Optional[Tuple[Any, ...]] = None
+        self._day_key_until = 0.0
+        # schedule strings -> (local day start, next day start, (start, stop_entries, flatten))
+        self._sched_cache: Dict[Tuple[str, ...], Tuple[datetime, datetime, Tuple[datetime, datetime, datetime]]] = {}
+        self._sched_last: Optional[Tuple[dict, datetime, datetime, Tuple[datetime, datetime, datetime]]] = None
+        # (local date, from_utc, to_utc) for calc_day_cashflow
+        self._pnl_window: Optional[Tuple[Any, datetime, datetime]] = None
+        # incremental calc_day_cashflow: running total for the day window + ops already counted
+        self._cf_day_from: Optional[datetime] = None
+        self._cf_cursor: Optional[datetime] = None
+        self._cf_total = 0.0
+        self._cf_seen: set = set()
+        # full-day re-read cadence: catches ops booked later than _CASHFLOW_OVERLAP (commissions, coupons)
+        self._cf_full_sec = float(cfg.get("cashflow_full_sec", 300))
+        self._cf_full_due = 0.0
         self.last_cash_rub: float = 0.0
 
-        self.journal = TradeJournal(cfg.get("trades_csv", "logs/trades.csv"))
+        # CSV rows are buffered in memory and written by a background thread
+        self.journal = BufferedJournal(
+            cfg.get("trades_csv", "logs/trades.csv"),
+            flush_sec=float(cfg.get("journal_flush_sec", 1.0)),
+            max_rows=int(cfg.get("journal_flush_rows", 50)),
+        )
+
+        # guards BotState between the loop and the background sync thread (start_background_sync)
+        self.state_lock = threading.RLock()
+        self._snap_lock = threading.Lock()
+        self._sync_stop = threading.Event()
+        self._sync_thread: Optional[threading.Thread] = None
+
+        # OrdersStream.TradesStream (start_orders_stream): figis with fresh executions are polled
+        # right away, the rest only every order_reconcile_sec (cancels/rejects aren't in the stream)
+        self._order_reconcile_sec = float(cfg.get("order_reconcile_sec", 60))
+        self._orders_stream_live = False
+        self._orders_stream_stop = threading.Event()
+        self._order_touched: set = set()
+        self._order_touched_lock = threading.Lock()
+        self._order_polled_at: Dict[str, float] = {}
+
+        # orders prepared this loop, posted together by submit_queued_orders()
+        self._order_queue: List[_PendingOrder] = []
+
+        # set by stream threads (closed bar, fill): the main loop wakes up early instead of sleeping it out
+        self.wakeup = threading.Event()
+
+        # 1m candles pushed by MarketDataStream (start_candle_stream); REST polling while not live
+        self._candle_bufs: Dict[str, CandleBuffer] = {}
+        self._candle_stream = None
+        self._candle_stream_live = False
+        self._candle_stream_stop = threading.Event()
 
     # ---------- logging ----------
-    def log(self, msg: str):
-        self.logger.info(msg)
-        print(msg)
+    def log(self, msg: str, *args):
+        # %-style args are formatted by logging only if the record is emitted
+        self.logger.info(msg, *args)
 
     def notify(self, text: str, throttle_sec: float = 0.0):
         if not self.notifier:
@@ -99,6 +264,7 @@ class Broker:
     # ---------- converters ----------
     @staticmethod
     def _to_float(x: Any) -> float:
+        """Generic/defensive conversion; Quotation/MoneyValue hot paths use _q_to_float."""
         if x is None:
             return 0.0
         if isinstance(x, (int, float)):
@@ -117,14 +283,14 @@ class Broker:
     # ---------- lot helpers ----------
     def _lot_size(self, figi: str) -> int:
         info = self._figi_info.get(figi)
-        return int(info.lot) if info and int(info.lot) > 0 else 1
+        return info.lot if info and info.lot > 0 else 1
 
     def _balance_to_lots(self, figi: str, balance_value: Any) -> int:
-        bal = float(self._to_float(balance_value))
+        bal = self._to_float(balance_value)
         lot = self._lot_size(figi)
         if lot <= 1:
             return int(bal)
-        lots = int(math.floor(bal / float(lot) + 1e-12))
+        lots = math.floor(bal / lot + 1e-12)
         return max(0, lots)
 
     # ---------- journal helpers ----------
@@ -141,7 +307,13 @@ class Broker:
 
     # ---------- day helpers ----------
     def _today_key(self) -> str:
-        return datetime.now(tz=ZoneInfo("UTC")).date().isoformat()
+        # UTC date string, rebuilt only when wall time crosses the next UTC midnight
+        t = time.time()
+        if t < self._day_key_until:
+            return self._day_key
+        self._day_key = datetime.fromtimestamp(t, tz=_UTC_TZ).date().isoformat()
+        self._day_key_until = (t // 86400 + 1) * 86400
+        return self._day_key
 
     def _ensure_day_rollover(self):
         today = self._today_key()
@@ -158,55 +330,73 @@ class Broker:
                 self.log(f"[WARN] API error (attempt {attempt}/{self._retry_tries}): {e}")
                 if attempt == self._retry_tries:
                     raise
-                time.sleep(sleep)
+                # jittered so pool workers hitting the same flaky endpoint don't retry in lockstep;
+                # snapshot/candle calls sleep on io pool threads, not on the trading loop
+                time.sleep(min(self._retry_sleep_max, sleep * random.uniform(0.5, 1.5)))
                 sleep = min(self._retry_sleep_max, sleep * 2)
 
     # ---------- schedule ----------
+    def _schedule_bounds(self, ts_utc: datetime, schedule_cfg: dict) -> Tuple[datetime, datetime, datetime]:
+        """
+        (start_trade, stop_new_entries, flatten_time) of ts_utc's local day as aware datetimes.
+        Aware datetimes compare correctly across tz, so predicates compare ts_utc directly;
+        bounds are rebuilt only when ts_utc leaves the cached local day.
+        """
+        # hot path: main passes the same schedule dict every tick
+        last = self._sched_last
+        if last is not None and last[0] is schedule_cfg and last[1] <= ts_utc < last[2]:
+            return last[3]
+
+        key = (
+            schedule_cfg["tz"],
+            schedule_cfg["start_trade"],
+            schedule_cfg["stop_new_entries"],
+            schedule_cfg["flatten_time"],
+        )
+        cached = self._sched_cache.get(key)
+        if cached is not None and cached[0] <= ts_utc < cached[1]:
+            self._sched_last = (schedule_cfg, *cached)
+            return cached[2]
+
+        tz = _tz(key[0])
+        d = ts_utc.astimezone(tz).date()
+        day_start = datetime.combine(d, dt_time.min, tzinfo=tz)
+        day_end = datetime.combine(d + timedelta(days=1), dt_time.min, tzinfo=tz)
+        bounds = (
+            datetime.combine(d, self._parse_hhmm(key[1]), tzinfo=tz),
+            datetime.combine(d, self._parse_hhmm(key[2]), tzinfo=tz),
+            datetime.combine(d, self._parse_hhmm(key[3]), tzinfo=tz),
+        )
+        self._sched_cache[key] = (day_start, day_end, bounds)
+        self._sched_last = (schedule_cfg, day_start, day_end, bounds)
+        return bounds
+
     def is_trading_time(self, ts_utc: datetime, schedule_cfg: dict) -> bool:
-        tz = ZoneInfo(schedule_cfg["tz"])
-        ts_local = ts_utc.astimezone(tz)
-        start = datetime.combine(ts_local.date(), self._parse_hhmm(schedule_cfg["start_trade"]), tzinfo=tz)
-        flatten = datetime.combine(ts_local.date(), self._parse_hhmm(schedule_cfg["flatten_time"]), tzinfo=tz)
-        return start <= ts_local <= flatten
+        start, _, flatten = self._schedule_bounds(ts_utc, schedule_cfg)
+        return start <= ts_utc <= flatten
 
     def new_entries_allowed(self, ts_utc: datetime, schedule_cfg: dict) -> bool:
-        tz = ZoneInfo(schedule_cfg["tz"])
-        ts_local = ts_utc.astimezone(tz)
-        stop_entries = datetime.combine(ts_local.date(), self._parse_hhmm(schedule_cfg["stop_new_entries"]), tzinfo=tz)
-        return ts_local <= stop_entries
+        _, stop_entries, _ = self._schedule_bounds(ts_utc, schedule_cfg)
+        return ts_utc <= stop_entries
 
     def flatten_due(self, ts_utc: datetime, schedule_cfg: dict) -> bool:
-        tz = ZoneInfo(schedule_cfg["tz"])
-        ts_local = ts_utc.astimezone(tz)
-        flatten = datetime.combine(ts_local.date(), self._parse_hhmm(schedule_cfg["flatten_time"]), tzinfo=tz)
-        return ts_local >= flatten
+        _, _, flatten = self._schedule_bounds(ts_utc, schedule_cfg)
+        return ts_utc >= flatten
 
     @staticmethod
+    @lru_cache(maxsize=64)
     def _parse_hhmm(s: str):
         hh, mm = s.split(":")
-        return datetime.strptime(f"{hh}:{mm}", "%H:%M").time()
-
-    # ---------- routing helpers ----------
-    def _positions_call(self):
-        return self.client.sandbox.get_sandbox_positions if self.use_sandbox else self.client.operations.get_positions
-
-    def _orders_list_call(self):
-        return self.client.sandbox.get_sandbox_orders if self.use_sandbox else self.client.orders.get_orders
-
-    def _order_post_call(self):
-        return self.client.sandbox.post_sandbox_order if self.use_sandbox else self.client.orders.post_order
-
-    def _order_cancel_call(self):
-        return self.client.sandbox.cancel_sandbox_order if self.use_sandbox else self.client.orders.cancel_order
-
-    def _order_state_call(self):
-        return self.client.sandbox.get_sandbox_order_state if self.use_sandbox else self.client.orders.get_order_state
-
-    def _operations_call(self):
-        return self.client.sandbox.get_sandbox_operations if self.use_sandbox else self.client.operations.get_operations
+        return dt_time(int(hh), int(mm))
 
     # ---------- accounts / sandbox ----------
     def pick_account_id(self) -> str:
+        if self._account_id:
+            return self._account_id
+        self._account_id = self._pick_account_id()
+        return self._account_id
+
+    def _pick_account_id(self) -> str:
         if self.use_sandbox:
             accs = self._call(self.client.sandbox.get_sandbox_accounts).accounts
             if not accs:
@@ -235,39 +425,56 @@ class Broker:
             raise RuntimeError("Нет доступных счетов")
         return resp.accounts[0].id
 
+    @staticmethod
+    def _float_to_quotation(x: float) -> Quotation:
+        """
+        float -> Quotation by int math (no str/Decimal round-trip).
+        units/nano keep the same sign, as the API expects; nano is rounded to 1e-9.
+        """
+        x = float(x)
+        units = int(x)  # trunc toward zero
+        nano = int(round((x - units) * 1_000_000_000))
+        if nano >= 1_000_000_000:
+            units += 1
+            nano -= 1_000_000_000
+        elif nano <= -1_000_000_000:
+            units -= 1
+            nano += 1_000_000_000
+        return Quotation(units=units, nano=nano)
+
     @staticmethod
     def _money_value(amount: float, currency: str):
-        q = decimal_to_quotation(Decimal(str(float(amount))))
+        q = Broker._float_to_quotation(amount)
         from tinkoff.invest import MoneyValue  # type: ignore
         return MoneyValue(units=q.units, nano=q.nano, currency=currency)
 
     # ---------- cash helpers ----------
     def get_cash_rub(self, account_id: str) -> float:
         try:
-            pos = self._call(self._positions_call(), account_id=account_id)
+            pos = self._call(self._fn_positions, account_id=account_id)
             cash = 0.0
             for m in pos.money:
                 if m.currency == self.currency:
-                    cash += float(self._to_float(m))
-            return float(cash)
+                    cash += _q_to_float(m)
+            return cash
         except Exception as e:
             self.log(f"[WARN] get_cash_rub failed: {e}")
             return 0.0
 
     def get_cached_cash_rub(self, account_id: str | None = None) -> float:
         if self.last_cash_rub > 0:
-            return float(self.last_cash_rub)
+            return self.last_cash_rub
         if account_id:
-            return float(self.get_cash_rub(account_id))
+            return self.get_cash_rub(account_id)
         return 0.0
 
     def _reserved_rub_total(self) -> float:
-        return float(sum(float(v) for v in self._reserved_rub_by_figi.values()))
+        return sum(self._reserved_rub_by_figi.values(), 0.0)
 
     def get_free_cash_rub_estimate(self, account_id: str | None = None) -> float:
         cash = self.get_cached_cash_rub(account_id)
         reserved = self._reserved_rub_total()
-        return float(max(0.0, float(cash) - float(reserved)))
+        return max(0.0, cash - reserved)
 
     # ---------- sandbox cash helpers ----------
     def ensure_sandbox_cash(self, account_id: str, min_cash_rub: float):
@@ -293,96 +500,193 @@ class Broker:
 
     # ---------- account snapshot ----------
     def refresh_account_snapshot(self, account_id: str, figis: List[str]):
-        self._ensure_day_rollover()
+        """
+        Whole-universe sync: one positions call + one orders call per account,
+        never per FIGI.
+        """
+        # one snapshot at a time (loop vs background sync): a second caller skips instead of queueing
+        # behind a hung request, so an older response can never be applied after a newer one
+        if not self._snap_lock.acquire(blocking=False):
+            return
+        try:
+            self._refresh_account_snapshot(account_id, figis)
+        finally:
+            self._snap_lock.release()
+
+    def _refresh_account_snapshot(self, account_id: str, figis: List[str]):
         figi_set = set(figis)
+        epoch = self.state.local_epoch
+
+        # both requests in flight at once; results applied in order below
+        pos_fut = self._io_pool.submit(self._call, self._fn_positions, account_id=account_id)
+        orders_fut = self._io_pool.submit(self._call, self._fn_orders, account_id=account_id)
 
         # Positions
+        by_figi_lots: Optional[Dict[str, int]] = None
         try:
-            pos = self._call(self._positions_call(), account_id=account_id)
+            pos = pos_fut.result()
 
             cash = 0.0
             for m in getattr(pos, "money", []) or []:
                 if getattr(m, "currency", None) == self.currency:
-                    cash += float(self._to_float(m))
-            self.last_cash_rub = float(cash)
+                    cash += _q_to_float(m)
+            self.last_cash_rub = cash
 
-            by_figi_lots: Dict[str, int] = {f: 0 for f in figi_set}
-            for sec in getattr(pos, "securities", []) or []:
-                f = getattr(sec, "figi", "")
+            # only figis actually held; absent ones read as 0 below
+            by_figi_lots = {}
+            for sec in getattr(pos, "securities", ()) or ():
+                f = sec.figi
                 if f in figi_set:
-                    bal = getattr(sec, "balance", 0)
-                    by_figi_lots[f] = int(self._balance_to_lots(f, bal))
-
-            for f in figi_set:
-                fs = self.state.get(f)
-                prev_lots = int(fs.position_lots)
-                fs.position_lots = int(by_figi_lots.get(f, 0))
-                if prev_lots > 0 and int(fs.position_lots) == 0:
-                    fs.entry_price = None
-                    fs.entry_time = None
+                    by_figi_lots[f] = self._balance_to_lots(f, sec.balance)
         except Exception as e:
             self.log(f"[WARN] get_positions failed: {e}")
 
         # Orders
+        active_by_figi: Optional[Dict[str, str]] = None
+        live_oids: set = set()
         try:
-            orders = self._call(self._orders_list_call(), account_id=account_id).orders
-            active_by_figi: Dict[str, str] = {}
+            orders = orders_fut.result().orders
+            active_by_figi = {}
             for o in orders:
-                f = getattr(o, "figi", "")
-                if f in figi_set and f not in active_by_figi:
-                    active_by_figi[f] = getattr(o, "order_id", "")
+                f = o.figi
+                if f in figi_set:
+                    live_oids.add(o.order_id)
+                    if f not in active_by_figi:
+                        active_by_figi[f] = o.order_id
+        except Exception as e:
+            self.log(f"[WARN] get_orders failed: {e}")
 
+        with self.state_lock:
+            self._ensure_day_rollover()
+            if self.state.local_epoch != epoch:
+                # orders were placed/cancelled locally while this view was in flight: it is older
+                # than local state, applying it could drop a just-placed order. Next sync catches up.
+                return
+            self._apply_snapshot(figis, figi_set, by_figi_lots, active_by_figi, live_oids)
+
+    def _apply_snapshot(
+        self,
+        figis: List[str],
+        figi_set: set,
+        by_figi_lots: Optional[Dict[str, int]],
+        active_by_figi: Optional[Dict[str, str]],
+        live_oids: set,
+    ):
+        # Idle account: same broker view and local state untouched since the last apply
+        # -> applying again would be a no-op. Local order placement/cancel changes local_sig.
+        sig = None
+        if by_figi_lots is not None and active_by_figi is not None:
+            sig = (tuple(sorted(by_figi_lots.items())), tuple(sorted(active_by_figi.items())))
+            if sig == self._snapshot_sig and self._local_snapshot_sig(figis) == self._snapshot_local_sig:
+                return
+
+        if by_figi_lots is not None:
             for f in figi_set:
                 fs = self.state.get(f)
-                fs.active_order_id = active_by_figi.get(f) or None
-                if fs.active_order_id is None:
-                    self.state.clear_order(f)
+                prev_lots = fs.position_lots
+                self.state.set_position_lots(f, by_figi_lots.get(f, 0))
+                if prev_lots > 0 and fs.position_lots == 0:
+                    fs.entry_price = None
+                    fs.entry_time = None
+
+        if active_by_figi is not None:
+            for f in figi_set:
+                local = self.state.get(f).active_order_id
+                if local is not None:
+                    # order events win over the snapshot: a tracked order that left the active
+                    # list is finalized by poll_order_updates (FILL/CANCEL journal, entry, reserve),
+                    # not silently cleared here
+                    if local not in live_oids:
+                        with self._order_touched_lock:
+                            self._order_touched.add(f)
+                    continue
+                oid = active_by_figi.get(f)
+                if oid:
+                    self.state.set_active_order(f, oid)  # working order we didn't place / lost track of
+                else:
                     self._reserved_rub_by_figi.pop(f, None)
-        except Exception as e:
-            self.log(f"[WARN] get_orders failed: {e}")
+
+        self._snapshot_sig = sig
+        self._snapshot_local_sig = self._local_snapshot_sig(figis) if sig is not None else None
+
+    def _local_snapshot_sig(self, figis: List[str]) -> Tuple[Any, ...]:
+        get = self.state.figi.get
+        return tuple((f, fs.position_lots, fs.active_order_id) if (fs := get(f)) else (f,) for f in figis)
 
     # ---------- instruments ----------
+    def _resolve_one(self, t: str) -> Optional[Tuple[str, InstrumentInfo]]:
+        try:
+            r = self._call(
+                self.client.instruments.share_by,
+                id=t,
+                id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_TICKER,
+                class_code=self.class_code,
+            )
+            share = r.instrument
+        except Exception as e:
+            self.log("[WARN] share_by failed for %s: %s", t, e)
+            return None
+
+        figi = share.figi
+        lot = int(share.lot)
+        mpi = _q_to_float(share.min_price_increment)
+
+        return t, InstrumentInfo(ticker=t, figi=figi, lot=lot, min_price_increment=mpi)
+
+    def invalidate_instruments(self):
+        self._instr_cache.clear()
+
     def resolve_instruments(self, tickers: List[str]) -> Dict[str, InstrumentInfo]:
         out: Dict[str, InstrumentInfo] = {}
+        if not tickers:
+            return out
+
+        ts = time.monotonic()
+        missing: List[str] = []
         for t in tickers:
-            try:
-                r = self._call(
-                    self.client.instruments.share_by,
-                    id=t,
-                    id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_TICKER,
-                    class_code=self.class_code,
-                )
-                share = r.instrument
-            except Exception as e:
-                self.log(f"[WARN] share_by failed for {t}: {e}")
-                continue
+            cached = self._instr_cache.get(t)
+            if cached and ts - cached[0] < self._instr_ttl_s:
+                out[t] = cached[1]
+            else:
+                missing.append(t)
 
-            figi = share.figi
-            lot = int(share.lot)
-            mpi = float(self._to_float(share.min_price_increment))
+        if missing:
+            # share_by is pure network wait -> overlap the calls
+            workers = min(self._resolve_workers, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                results = list(ex.map(self._resolve_one, missing))
 
-            info = InstrumentInfo(ticker=t, figi=figi, lot=lot, min_price_increment=float(mpi))
-            out[t] = info
-            self._figi_info[figi] = info
+            for res in results:
+                if res is None:
+                    continue
+                t, info = res
+                out[t] = info
+                self._instr_cache[t] = (ts, info)
+                self._figi_info[info.figi] = info
 
-        return out
+        # keep caller's ticker order
+        return {t: out[t] for t in tickers if t in out}
 
     def pick_tradeable_figis(self, universe_cfg: dict, max_lot_cost: float) -> List[str]:
         instruments = self.resolve_instruments(universe_cfg["tickers"])
         figis: List[str] = []
+        max_lot_cost = float(max_lot_cost)
+
+        # one get_last_prices round-trip for the whole universe
+        prices = self.get_last_prices_bulk([info.figi for info in instruments.values()])
 
         for t, info in instruments.items():
-            last_price = self.get_last_price(info.figi)
+            last_price = prices.get(info.figi)
             if last_price is None:
-                self.log(f"[SKIP] {t} no last price")
+                self.log("[SKIP] %s no last price", t)
                 continue
 
-            lot_cost = float(last_price) * int(info.lot)
-            if lot_cost <= float(max_lot_cost):
+            lot_cost = last_price * info.lot
+            if lot_cost <= max_lot_cost:
                 figis.append(info.figi)
-                self.log(f"[OK] {t} {info.figi} lot={info.lot} lot_cost≈{lot_cost:.2f}")
+                self.log("[OK] %s %s lot=%d lot_cost≈%.2f", t, info.figi, info.lot, lot_cost)
             else:
-                self.log(f"[SKIP] {t} lot_cost≈{lot_cost:.2f} > {float(max_lot_cost):.2f}")
+                self.log("[SKIP] %s lot_cost≈%.2f > %.2f", t, lot_cost, max_lot_cost)
 
         return figis
 
@@ -391,49 +695,54 @@ class Broker:
     def _round_to_step_down(price: float, step: float) -> float:
         if step <= 0:
             return float(price)
-        return float(math.floor(float(price) / float(step)) * float(step))
+        return math.floor(price / step) * step
 
     @staticmethod
     def _round_to_step_up(price: float, step: float) -> float:
         if step <= 0:
             return float(price)
-        return float(math.ceil(float(price) / float(step)) * float(step))
+        return math.ceil(price / step) * step
 
     def _normalize_price(self, figi: str, price: float, side: str) -> float:
         info = self._figi_info.get(figi)
         if not info:
             return float(price)
-        step = float(info.min_price_increment) if info.min_price_increment else 0.0
+        step = info.min_price_increment or 0.0
         p = float(price)
         if side.upper() == "BUY":
-            return float(self._round_to_step_up(p, step))
-        return float(self._round_to_step_down(p, step))
+            return self._round_to_step_up(p, step)
+        return self._round_to_step_down(p, step)
 
     # NEW: "closest to current" limit price in ticks
-    def _aggressive_near_last(self, figi: str, side: str, suggested_price: float) -> float:
+    def _aggressive_near_last(
+        self, figi: str, side: str, suggested_price: float, last: Optional[float] = None
+    ) -> float:
         """
         Make price максимально близко к last:
           BUY -> around last + buy_aggressive_ticks * step (rounded up)
           SELL -> around last - sell_aggressive_ticks * step (rounded down)
         If last is unavailable, fall back to suggested_price.
+        `last` — already known last price (e.g. from a bulk fetch): skips the get_last_price RPC.
         """
         info = self._figi_info.get(figi)
-        step = float(info.min_price_increment) if info and info.min_price_increment else 0.0
-        last = self.get_last_price(figi)
+        step = info.min_price_increment if info and info.min_price_increment else 0.0
+        suggested = float(suggested_price)
+        if last is None:
+            last = self.get_last_price(figi)
 
         if last is None or step <= 0:
-            return float(self._normalize_price(figi, float(suggested_price), side=side))
+            return self._normalize_price(figi, suggested, side=side)
 
         if side.upper() == "BUY":
-            target = float(last) + float(self.buy_aggressive_ticks) * step
+            target = last + self.buy_aggressive_ticks * step
             # keep not worse than suggested (so if strategy wants higher, allow it)
-            p = max(float(suggested_price), target)
-            return float(self._normalize_price(figi, p, side="BUY"))
+            p = max(suggested, target)
+            return self._normalize_price(figi, p, side="BUY")
 
         # SELL
-        target = float(last) - float(self.sell_aggressive_ticks) * step
-        p = min(float(suggested_price), target)
-        return float(self._normalize_price(figi, p, side="SELL"))
+        target = last - self.sell_aggressive_ticks * step
+        p = min(suggested, target)
+        return self._normalize_price(figi, p, side="SELL")
 
     # ---------- market data ----------
     def get_last_price(self, figi: str) -> Optional[float]:
@@ -441,49 +750,227 @@ class Broker:
             r = self._call(self.client.market_data.get_last_prices, figi=[figi])
             if not r.last_prices:
                 return None
-            return float(self._to_float(r.last_prices[0].price))
+            return _q_to_float(r.last_prices[0].price)
         except Exception:
             return None
 
-    def get_last_candles_1m(self, figi: str, lookback_minutes: int) -> Optional[pd.DataFrame]:
+    def get_last_prices_bulk(self, figis: List[str]) -> Dict[str, float]:
+        if not figis:
+            return {}
+        try:
+            r = self._call(self.client.market_data.get_last_prices, figi=list(figis))
+            return {lp.figi: _q_to_float(lp.price) for lp in r.last_prices}
+        except Exception as e:
+            self.log(f"[WARN] get_last_prices failed: {e}")
+            return {}
+
+    def get_last_candles_1m(self, figi: str, lookback_minutes: int) -> Optional[Candles]:
         to_ = now()
         from_ = to_ - timedelta(minutes=lookback_minutes + 5)
 
         try:
-            candles = []
-            for c in self.client.get_all_candles(
-                figi=figi,
-                from_=from_,
-                to=to_,
-                interval=CandleInterval.CANDLE_INTERVAL_1_MIN,
-            ):
-                candles.append(c)
-
-            if not candles:
+            # stream straight into a preallocated (4, cap) OHLC float64 buffer, one write per
+            # candle (Quotation -> units + nano * 1e-9, no Decimal); one 1m bar per minute of
+            # window, resize only if the API returns more
+            cap = int(lookback_minutes) + 5
+            times: List[Any] = [None] * cap
+            ohlc = np.empty((4, cap))
+            v = np.empty(cap)  # float64 like close: VWAP's dot(close, volume) needs no cast
+
+            if lookback_minutes + 5 <= _MAX_1M_CANDLES_WINDOW_MIN:
+                # fits in one GetCandles request: single RPC (with _call retry/backoff), no paginator
+                src = self._call(
+                    self.client.market_data.get_candles,
+                    figi=figi,
+                    from_=from_,
+                    to=to_,
+                    interval=CandleInterval.CANDLE_INTERVAL_1_MIN,
+                ).candles
+            else:
+                src = self.client.get_all_candles(
+                    figi=figi,
+                    from_=from_,
+                    to=to_,
+                    interval=CandleInterval.CANDLE_INTERVAL_1_MIN,
+                )
+
+            n = 0
+            for x in src:
+                if n == cap:
+                    cap *= 2
+                    times.extend([None] * (cap - n))
+                    grown = np.empty((4, cap))
+                    grown[:, :n] = ohlc
+                    ohlc = grown
+                    v = np.resize(v, cap)
+                times[n] = x.time
+                o, h, l, c = x.open, x.high, x.low, x.close
+                ohlc[:, n] = (
+                    o.units + o.nano * 1e-9,
+                    h.units + h.nano * 1e-9,
+                    l.units + l.nano * 1e-9,
+                    c.units + c.nano * 1e-9,
+                )
+                v[n] = x.volume
+                n += 1
+
+            if n == 0:
                 return None
 
-            df = pd.DataFrame(
-                {
-                    "time": [x.time for x in candles],
-                    "open": [float(self._to_float(x.open)) for x in candles],
-                    "high": [float(self._to_float(x.high)) for x in candles],
-                    "low": [float(self._to_float(x.low)) for x in candles],
-                    "close": [float(self._to_float(x.close)) for x in candles],
-                    "volume": [int(x.volume) for x in candles],
-                }
-            )
-            return df
+            # rows of the (4, cap) buffer are contiguous -> columns are plain views, no DataFrame
+            # machinery per fetch; time stays tz-aware (UTC): strategy subtracts entry_time from it
+            return Candles(times[:n], ohlc[0, :n], ohlc[1, :n], ohlc[2, :n], ohlc[3, :n], v[:n])
         except RequestError as e:
             self.log(f"[WARN] candles error {figi}: {e}")
             return None
 
+    def _submit_candles(self, figis: List[str], lookback_minutes: int) -> Dict[str, "Future[Optional[Candles]]"]:
+        return {f: self._io_pool.submit(self.get_last_candles_1m, f, lookback_minutes) for f in figis}
+
+    def fetch_all_candles(self, figis: List[str], lookback_minutes: int) -> Dict[str, Optional[Candles]]:
+        """
+        Candles for the whole universe at once: per-FIGI requests overlap on the
+        shared io pool (io_workers caps concurrency vs API rate limits).
+        """
+        futs = self._submit_candles(figis, lookback_minutes)
+        return {f: fut.result() for f, fut in futs.items()}
+
+    def refresh_snapshot_and_candles(
+        self, account_id: str, figis: List[str], lookback_minutes: int
+    ) -> Dict[str, Optional[Candles]]:
+        """
+        One loop tick of I/O: candle requests are queued first, so they run
+        alongside the positions/orders snapshot instead of after it.
+        """
+        # with background sync on, the snapshot is kept fresh off-loop
+        sync_inline = not self.background_sync_active
+
+        if self._candle_stream_live:
+            # candles are already in memory; only the snapshot goes over the wire
+            if sync_inline:
+                self.refresh_account_snapshot(account_id, figis)
+            return {f: self._candle_bufs[f].snapshot() if f in self._candle_bufs else None for f in figis}
+
+        futs = self._submit_candles(figis, lookback_minutes)
+        if sync_inline:
+            self.refresh_account_snapshot(account_id, figis)
+        return {f: fut.result() for f, fut in futs.items()}
+
+    # ---------- background sync ----------
+    @property
+    def background_sync_active(self) -> bool:
+        t = self._sync_thread
+        return t is not None and t.is_alive()
+
+    def start_background_sync(self, account_id: str, figis: List[str], interval_sec: float = 5.0):
+        """
+        Keeps positions/orders/cash in BotState fresh from a daemon thread, so the
+        loop reads local state instead of waiting on the snapshot round trip.
+        The loop holds state_lock while it works on orders; snapshots fetched
+        across a local order change are dropped (see BotState.local_epoch).
+        """
+        if self.background_sync_active:
+            return
+        self._sync_stop.clear()
+        figis = list(figis)
+
+        def run():
+            while True:
+                try:
+                    self.refresh_account_snapshot(account_id, figis)
+                except Exception as e:
+                    self.log("[WARN] background sync failed: %s", e)
+                if self._sync_stop.wait(interval_sec):
+                    return
+
+        self._sync_thread = threading.Thread(target=run, name="state-sync", daemon=True)
+        self._sync_thread.start()
+
+    def stop_background_sync(self):
+        self._sync_stop.set()
+
+    # ---------- market data stream ----------
+    def start_candle_stream(self, figis: List[str], lookback_minutes: int):
+        """
+        Push-based 1m candles: a daemon thread subscribes to MarketDataStream and
+        writes updates into per-FIGI CandleBuffer. Each (re)connect first reloads
+        the window over REST, so a dropped stream never leaves a gap.
+        """
+        cap = int(lookback_minutes) + 5
+        self._candle_bufs = {f: CandleBuffer(cap) for f in figis}
+        self._candle_stream_stop.clear()
+        threading.Thread(
+            target=self._candle_stream_loop,
+            args=(list(figis), int(lookback_minutes)),
+            name="md-stream",
+            daemon=True,
+        ).start()
+
+    def stop_candle_stream(self):
+        self._candle_stream_stop.set()
+        self._candle_stream_live = False
+        stream = self._candle_stream
+        if stream is not None:
+            try:
+                stream.stop()
+            except Exception:
+                pass
+
+    def _candle_stream_loop(self, figis: List[str], lookback_minutes: int):
+        instruments = [
+            CandleInstrument(figi=f, interval=SubscriptionInterval.SUBSCRIPTION_INTERVAL_ONE_MINUTE) for f in figis
+        ]
+        stop = self._candle_stream_stop
+        backoff = self._retry_sleep_min
+
+        while not stop.is_set():
+            try:
+                for f, c in self.fetch_all_candles(figis, lookback_minutes).items():
+                    if c is not None:
+                        self._candle_bufs[f].load(c)
+
+                stream = self.client.create_market_data_stream()
+                self._candle_stream = stream
+                stream.candles.subscribe(instruments)
+                self._candle_stream_live = True
+                self.log("[INFO] market data stream: subscribed to 1m candles for %d FIGIs", len(figis))
+
+                for md in stream:
+                    if stop.is_set():
+                        break
+                    c = md.candle
+                    if c is None:
+                        continue
+                    buf = self._candle_bufs.get(c.figi)
+                    if buf is not None:
+                        o, h, l, cl = c.open, c.high, c.low, c.close
+                        new_bar = buf.update(
+                            c.time,
+                            o.units + o.nano * 1e-9,
+                            h.units + h.nano * 1e-9,
+                            l.units + l.nano * 1e-9,
+                            cl.units + cl.nano * 1e-9,
+                            c.volume,
+                        )
+                        if new_bar:
+                            self.wakeup.set()  # previous bar closed: worth a strategy pass now
+                    backoff = self._retry_sleep_min
+            except Exception as e:
+                if not stop.is_set():
+                    self.log("[WARN] market data stream dropped: %s", e)
+            finally:
+                self._candle_stream_live = False
+
+            stop.wait(min(self._retry_sleep_max, backoff * random.uniform(0.5, 1.5)))
+            backoff = min(self._retry_sleep_max, backoff * 2)
+
     # ---------- portfolio status ----------
     def build_portfolio_status(self, account_id: str, figis: List[str], title: str = "") -> str:
         self.refresh_account_snapshot(account_id, figis)
 
-        cash = float(self.get_cached_cash_rub(account_id))
-        reserved = float(self._reserved_rub_total())
-        free = float(max(0.0, cash - reserved))
+        cash = self.get_cached_cash_rub(account_id)
+        reserved = self._reserved_rub_total()
+        free = max(0.0, cash - reserved)
 
         lines: List[str] = []
         if title:
@@ -492,16 +979,17 @@ class Broker:
         lines.append(f"Cash: {cash:,.2f} RUB | Free≈{free:,.2f} | Reserved≈{reserved:,.2f}")
         lines.append("Positions:")
 
+        held = [f for f in figis if self.state.get(f).position_lots > 0]
+        prices = self.get_last_prices_bulk(held)
+
         any_pos = False
-        for figi in figis:
+        for figi in held:
             fs = self.state.get(figi)
-            lots = int(fs.position_lots)
-            if lots <= 0:
-                continue
+            lots = fs.position_lots
             any_pos = True
 
             lot_size = self._lot_size(figi)
-            last = self.get_last_price(figi)
+            last = prices.get(figi)
             ticker = self._ticker_for_figi(figi) or figi
 
             entry = fs.entry_price
@@ -509,11 +997,11 @@ class Broker:
                 lines.append(f"  {ticker:<5} lots={lots:<3} entry=N/A last={last if last is not None else 'N/A'}")
                 continue
 
-            pnl_abs = (float(last) - float(entry)) * float(lot_size) * float(lots)
-            pnl_pct = (float(last) / float(entry) - 1.0) * 100.0
+            pnl_abs = (last - entry) * lot_size * lots
+            pnl_pct = (last / entry - 1.0) * 100.0
 
             lines.append(
-                f"  {ticker:<5} lots={lots:<3} entry={float(entry):.4f} last={float(last):.4f} "
+                f"  {ticker:<5} lots={lots:<3} entry={entry:.4f} last={last:.4f} "
                 f"PnL={pnl_abs:+.2f} RUB ({pnl_pct:+.2f}%)"
             )
 
@@ -523,6 +1011,11 @@ class Broker:
         return "\n".join(lines)
 
     # ---------- orders ----------
+    @staticmethod
+    def _new_client_uid() -> str:
+        # idempotency key: 32 hex chars (API limit is 36), cheaper than str(uuid4())
+        return secrets.token_hex(16)
+
     def _is_not_found_error(self, e: Exception) -> bool:
         s = str(e).upper()
         return ("NOT_FOUND" in s) or ("ORDER NOT FOUND" in s)
@@ -536,8 +1029,8 @@ class Broker:
         cuid = fs.client_order_uid or ""
 
         try:
-            self._call(self._order_cancel_call(), account_id=account_id, order_id=oid)
-            self.log(f"[CANCEL] {self.format_instrument(figi)} order_id={oid}")
+            self._call(self._fn_cancel_order, account_id=account_id, order_id=oid)
+            self.log("[CANCEL] %s order_id=%s", self.format_instrument(figi), oid)
             self.notify(f"[CANCEL] {self._ticker_for_figi(figi) or figi} order_id={oid}", throttle_sec=0)
 
             self.journal_event(
@@ -553,30 +1046,30 @@ class Broker:
             )
         except Exception as e:
             if self._is_not_found_error(e):
-                self.log(f"[CANCEL] {self.format_instrument(figi)} order_id={oid} already gone (NOT_FOUND)")
+                self.log("[CANCEL] %s order_id=%s already gone (NOT_FOUND)", self.format_instrument(figi), oid)
             else:
-                self.log(f"[WARN] cancel_order failed: {e}")
+                self.log("[WARN] cancel_order failed: %s", e)
                 self.notify(f"[WARN] cancel failed: {self._ticker_for_figi(figi) or figi} | {e}", throttle_sec=120)
                 return
         finally:
             self.state.clear_order(figi)
             self._reserved_rub_by_figi.pop(figi, None)
 
-    def place_limit_buy(self, account_id: str, figi: str, price: float, quantity_lots: int = 1) -> bool:
+    def _prepare_buy(self, account_id: str, figi: str, price: float, quantity_lots: int) -> Optional[_PendingOrder]:
         fs = self.state.get(figi)
         if fs.active_order_id:
-            return False
-        if int(fs.position_lots) > 0:
-            return False
+            return None
+        if fs.position_lots > 0:
+            return None
 
         # NEW: price near last (ticks)
-        price_f = self._aggressive_near_last(figi, "BUY", float(price))
+        price_f = self._aggressive_near_last(figi, "BUY", price)
 
         lot_size = self._lot_size(figi)
-        est_cost = float(price_f) * float(lot_size) * float(quantity_lots)
+        est_cost = price_f * lot_size * quantity_lots
 
         cash = self.get_cached_cash_rub(account_id) or self.get_cash_rub(account_id)
-        free_cash = float(max(0.0, float(cash) - float(self._reserved_rub_total())))
+        free_cash = max(0.0, cash - self._reserved_rub_total())
 
         if cash > 0 and free_cash < est_cost * 1.01:
             now_ts = time.time()
@@ -594,134 +1087,220 @@ class Broker:
                 "SKIP",
                 figi,
                 side="BUY",
-                lots=int(quantity_lots),
-                price=float(price_f),
+                lots=quantity_lots,
+                price=price_f,
                 order_id=None,
                 client_uid=None,
                 status="NO_CASH",
                 reason="insufficient_free_cash_precheck",
                 meta={"cash": cash, "reserved": self._reserved_rub_total(), "free": free_cash, "need": est_cost},
             )
-            return False
+            return None
+
+        p = _PendingOrder(figi, "BUY", quantity_lots, price_f, self._new_client_uid(), est_cost)
+        # reserve before posting: later BUYs in the same batch see the cash as taken
+        self._reserved_rub_by_figi[figi] = est_cost
+        self._mark_pending(fs, p)
+        return p
+
+    def _prepare_sell_to_close(
+        self, account_id: str, figi: str, price: float, last: Optional[float] = None
+    ) -> Optional[_PendingOrder]:
+        fs = self.state.get(figi)
+        if fs.position_lots <= 0:
+            return None
 
-        client_uid = str(uuid.uuid4())
-        q = decimal_to_quotation(Decimal(str(price_f)))
+        # NEW: price near last (ticks)
+        price_f = self._aggressive_near_last(figi, "SELL", price, last=last)
 
+        replace_oid = None
+        if fs.active_order_id:
+            if fs.order_side == "SELL" and fs.order_placed_ts is not None:
+                if fs.order_price == price_f:
+                    return None  # our close order already works at this price
+                if self._fn_replace_order is not None:
+                    # one ReplaceOrder instead of cancel + post: half the round trips
+                    replace_oid = fs.active_order_id
+            if replace_oid is None:
+                self.cancel_active_order(account_id, figi, reason="replace_before_sell")
+
+        p = _PendingOrder(figi, "SELL", fs.position_lots, price_f, self._new_client_uid(), replace_oid=replace_oid)
+        if replace_oid is not None:
+            p.prev_uid, p.prev_placed_ts = fs.client_order_uid, fs.order_placed_ts
+        self._mark_pending(fs, p)
+        return p
+
+    def _mark_pending(self, fs, p: _PendingOrder):
+        # provisional until post_order answers: the request uid stands in for the order id,
+        # so risk limits count the order as working; no placed_ts -> TTL expiry ignores it
+        self.state.set_active_order(p.figi, p.client_uid)
+        fs.client_order_uid = p.client_uid
+        fs.order_side = p.side
+        fs.order_placed_ts = None
+
+    def _undo_pending(self, p: _PendingOrder):
+        """Roll back _mark_pending for an order that was not (re)posted."""
+        fs = self.state.get(p.figi)
+        if p.replace_oid is not None:
+            # failed replace: the old SELL is still live at the exchange, keep tracking it
+            # (order_price was never touched and still holds its price)
+            self.state.set_active_order(p.figi, p.replace_oid)
+            fs.client_order_uid = p.prev_uid
+            fs.order_placed_ts = p.prev_placed_ts
+            return
+        self.state.clear_order(p.figi)
+        if p.side == "BUY":
+            self._reserved_rub_by_figi.pop(p.figi, None)
+
+    def _post_pending(self, account_id: str, p: _PendingOrder) -> Tuple[Any, Optional[Exception]]:
         try:
+            if p.replace_oid is not None:
+                try:
+                    r = self._call(
+                        self._fn_replace_order,
+                        request=ReplaceOrderRequest(
+                            account_id=account_id,
+                            order_id=p.replace_oid,
+                            idempotency_key=p.client_uid,
+                            quantity=p.lots,
+                            price=self._float_to_quotation(p.price),
+                            price_type=PriceType.PRICE_TYPE_CURRENCY,
+                        ),
+                    )
+                    return r, None
+                except Exception as e:
+                    self.log("[WARN] replace_order %s failed, falling back to cancel + post: %s", p.figi, e)
+                # cancel failure (incl. NOT_FOUND: maybe filled) raises -> old order stays tracked,
+                # poll_order_updates settles it; only a confirmed cancel lets the new SELL go out
+                self._call(self._fn_cancel_order, account_id=account_id, order_id=p.replace_oid)
+                p.cancelled_oid, p.replace_oid = p.replace_oid, None
             r = self._call(
-                self._order_post_call(),
+                self._fn_post_order,
                 account_id=account_id,
-                figi=figi,
-                quantity=int(quantity_lots),
-                price=Quotation(units=q.units, nano=q.nano),
-                direction=OrderDirection.ORDER_DIRECTION_BUY,
+                figi=p.figi,
+                quantity=p.lots,
+                price=self._float_to_quotation(p.price),
+                direction=OrderDirection.ORDER_DIRECTION_BUY if p.side == "BUY" else OrderDirection.ORDER_DIRECTION_SELL,
                 order_type=OrderType.ORDER_TYPE_LIMIT,
-                order_id=client_uid,
+                order_id=p.client_uid,
             )
+            return r, None
+        except Exception as e:
+            return None, e
 
-            fs.client_order_uid = client_uid
-            fs.active_order_id = r.order_id
-            fs.order_side = "BUY"
-            fs.order_placed_ts = now()
-
-            self._reserved_rub_by_figi[figi] = float(est_cost)
-
-            inst = self.format_instrument(figi)
-            cash2 = self.get_cached_cash_rub(account_id)
-            free2 = self.get_free_cash_rub_estimate(account_id)
-            self.log(
-                f"[ORDER] BUY {inst} qty={int(quantity_lots)} price={price_f} "
-                f"| cash≈{cash2:.2f} free≈{free2:.2f} {self.currency.upper()} (client_uid={client_uid})"
-            )
-            self.notify(
-                f"[ORDER] BUY {inst} qty={int(quantity_lots)} price={price_f} | free≈{free2:.2f} {self.currency.upper()}",
-                throttle_sec=0,
-            )
+    def _finish_order(self, account_id: str, p: _PendingOrder, r: Any, err: Optional[Exception]) -> bool:
+        figi = p.figi
+        fs = self.state.get(figi)
 
+        if p.cancelled_oid is not None:
+            self.log("[CANCEL] %s order_id=%s", self.format_instrument(figi), p.cancelled_oid)
             self.journal_event(
-                "SUBMIT",
+                "CANCEL",
                 figi,
-                side="BUY",
-                lots=int(quantity_lots),
-                price=float(price_f),
-                order_id=r.order_id,
-                client_uid=client_uid,
-                status="NEW",
-                reason="limit_buy",
-                meta={"est_cost": est_cost},
+                side=p.side,
+                order_id=p.cancelled_oid,
+                client_uid=p.prev_uid or "",
+                status="CANCELLED",
+                reason="replace_failed_cancel",
             )
 
-            return True
-        except Exception as e:
-            self.log(f"[WARN] post_order BUY failed: {e}")
-            self.notify(f"[WARN] BUY submit failed: {self._ticker_for_figi(figi) or figi} | {e}", throttle_sec=120)
-            self.state.clear_order(figi)
-            self._reserved_rub_by_figi.pop(figi, None)
-            return False
-
-    def place_limit_sell_to_close(self, account_id: str, figi: str, price: float) -> bool:
-        fs = self.state.get(figi)
-        if int(fs.position_lots) <= 0:
+        if err is not None:
+            self.log("[WARN] post_order %s failed: %s", p.side, err)
+            self.notify(f"[WARN] {p.side} submit failed: {self._ticker_for_figi(figi) or figi} | {err}", throttle_sec=120)
+            self._undo_pending(p)
             return False
 
-        if fs.active_order_id:
-            self.cancel_active_order(account_id, figi, reason="replace_before_sell")
+        self.state.set_active_order(figi, r.order_id)
+        fs.order_placed_ts = now()
+        fs.order_price = p.price
 
-        # NEW: price near last (ticks)
-        price_f = self._aggressive_near_last(figi, "SELL", float(price))
-
-        client_uid = str(uuid.uuid4())
-        q = decimal_to_quotation(Decimal(str(price_f)))
+        inst = self.format_instrument(figi)
+        cash = self.get_cached_cash_rub(account_id)
+        free = self.get_free_cash_rub_estimate(account_id)
+        cur = self.currency.upper()
 
-        try:
-            r = self._call(
-                self._order_post_call(),
-                account_id=account_id,
-                figi=figi,
-                quantity=int(fs.position_lots),
-                price=Quotation(units=q.units, nano=q.nano),
-                direction=OrderDirection.ORDER_DIRECTION_SELL,
-                order_type=OrderType.ORDER_TYPE_LIMIT,
-                order_id=client_uid,
+        if p.side == "BUY":
+            self.log(
+                "[ORDER] BUY %s qty=%d price=%s | cash≈%.2f free≈%.2f %s (client_uid=%s)",
+                inst, p.lots, p.price, cash, free, cur, p.client_uid,
             )
-
-            fs.client_order_uid = client_uid
-            fs.active_order_id = r.order_id
-            fs.order_side = "SELL"
-            fs.order_placed_ts = now()
-
+            self.notify(f"[ORDER] BUY {inst} qty={p.lots} price={p.price} | free≈{free:.2f} {cur}", throttle_sec=0)
+            reason, meta = "limit_buy", {"est_cost": p.est_cost}
+        else:
             self._reserved_rub_by_figi.pop(figi, None)
-
-            inst = self.format_instrument(figi)
-            cash = self.get_cached_cash_rub(account_id)
-            free = self.get_free_cash_rub_estimate(account_id)
             self.log(
-                f"[ORDER] SELL {inst} qty={int(fs.position_lots)} price={price_f} "
-                f"| cash≈{cash:.2f} free≈{free:.2f} {self.currency.upper()} (client_uid={client_uid})"
-            )
-            self.notify(
-                f"[ORDER] SELL {inst} qty={int(fs.position_lots)} price={price_f} | cash≈{cash:.2f} {self.currency.upper()}",
-                throttle_sec=0,
+                "[ORDER] SELL %s qty=%d price=%s | cash≈%.2f free≈%.2f %s (client_uid=%s)",
+                inst, p.lots, p.price, cash, free, cur, p.client_uid,
             )
+            self.notify(f"[ORDER] SELL {inst} qty={p.lots} price={p.price} | cash≈{cash:.2f} {cur}", throttle_sec=0)
+            if p.replace_oid is None:
+                reason, meta = "limit_sell_to_close", None
+            else:
+                reason, meta = "limit_sell_replace", {"replaced_order_id": p.replace_oid}
 
-            self.journal_event(
-                "SUBMIT",
-                figi,
-                side="SELL",
-                lots=int(fs.position_lots),
-                price=float(price_f),
-                order_id=r.order_id,
-                client_uid=client_uid,
-                status="NEW",
-                reason="limit_sell_to_close",
-            )
+        self.journal_event(
+            "SUBMIT",
+            figi,
+            side=p.side,
+            lots=p.lots,
+            price=p.price,
+            order_id=r.order_id,
+            client_uid=p.client_uid,
+            status="NEW",
+            reason=reason,
+            meta=meta,
+        )
+        return True
 
-            return True
-        except Exception as e:
-            self.log(f"[WARN] post_order SELL failed: {e}")
-            self.notify(f"[WARN] SELL submit failed: {self._ticker_for_figi(figi) or figi} | {e}", throttle_sec=120)
-            self.state.clear_order(figi)
+    def place_limit_buy(self, account_id: str, figi: str, price: float, quantity_lots: int = 1) -> bool:
+        p = self._prepare_buy(account_id, figi, price, quantity_lots)
+        if p is None:
+            return False
+        return self._finish_order(account_id, p, *self._post_pending(account_id, p))
+
+    def place_limit_sell_to_close(self, account_id: str, figi: str, price: float, last: Optional[float] = None) -> bool:
+        p = self._prepare_sell_to_close(account_id, figi, price, last=last)
+        if p is None:
+            return False
+        return self._finish_order(account_id, p, *self._post_pending(account_id, p))
+
+    # ---------- order batch ----------
+    def queue_limit_buy(self, account_id: str, figi: str, price: float, quantity_lots: int = 1) -> bool:
+        """Same checks/reservation as place_limit_buy, but the post waits for submit_queued_orders()."""
+        p = self._prepare_buy(account_id, figi, price, quantity_lots)
+        if p is None:
+            return False
+        self._order_queue.append(p)
+        return True
+
+    def queue_limit_sell_to_close(self, account_id: str, figi: str, price: float) -> bool:
+        p = self._prepare_sell_to_close(account_id, figi, price)
+        if p is None:
             return False
+        self._order_queue.append(p)
+        return True
+
+    def submit_queued_orders(self, account_id: str) -> int:
+        """
+        Posts everything queued this loop at once: the post_order calls overlap
+        on the io pool (~1 RTT for the batch instead of one per order); results
+        are applied back on the caller's thread in queue order.
+        """
+        queued, self._order_queue = self._order_queue, []
+        if not queued:
+            return 0
+        if len(queued) == 1:
+            results = [self._post_pending(account_id, queued[0])]
+        else:
+            results = list(self._io_pool.map(lambda p: self._post_pending(account_id, p), queued))
+        return sum(self._finish_order(account_id, p, r, err) for p, (r, err) in zip(queued, results))
+
+    def discard_queued_orders(self) -> int:
+        """Drops everything queued this loop unposted: state and BUY reservations are rolled back."""
+        queued, self._order_queue = self._order_queue, []
+        for p in queued:
+            self._undo_pending(p)
+        return len(queued)
 
     # ---------- TTL expire ----------
     def expire_stale_orders(self, account_id: str, figi: str, ttl_sec: int) -> bool:
@@ -730,7 +1309,7 @@ class Broker:
             return False
 
         age = (now() - fs.order_placed_ts).total_seconds()
-        if age < float(ttl_sec):
+        if age < ttl_sec:
             return False
 
         inst = self.format_instrument(figi)
@@ -747,23 +1326,82 @@ class Broker:
             client_uid=fs.client_order_uid,
             status="EXPIRED",
             reason="ttl_expired",
-            meta={"age_sec": float(age), "ttl_sec": int(ttl_sec)},
+            meta={"age_sec": age, "ttl_sec": ttl_sec},
         )
 
         self.cancel_active_order(account_id, figi, reason="ttl_expired")
         return True
 
+    # ---------- orders stream ----------
+    def start_orders_stream(self, account_id: str):
+        """
+        Push-based fills: a daemon thread listens to TradesStream and marks the
+        FIGI, so poll_order_updates() hits get_order_state only when something
+        executed (plus a periodic reconcile). Not available in sandbox.
+        """
+        if self.use_sandbox:
+            self.log("[WARN] orders stream is not supported in sandbox -> polling order state")
+            return
+        self._orders_stream_stop.clear()
+        threading.Thread(target=self._orders_stream_loop, args=(account_id,), name="orders-stream", daemon=True).start()
+
+    def stop_orders_stream(self):
+        self._orders_stream_stop.set()
+        self._orders_stream_live = False
+
+    def _orders_stream_loop(self, account_id: str):
+        stop = self._orders_stream_stop
+        backoff = self._retry_sleep_min
+
+        while not stop.is_set():
+            try:
+                # fills during the gap before (re)connect: poll every working order once
+                self._order_polled_at.clear()
+                self._orders_stream_live = True
+                self.log("[INFO] orders stream: listening for trades on %s", account_id)
+                for ev in self.client.orders_stream.trades_stream(accounts=[account_id]):
+                    if stop.is_set():
+                        break
+                    ot = ev.order_trades
+                    if ot is None or not ot.figi:
+                        continue  # ping
+                    with self._order_touched_lock:
+                        self._order_touched.add(ot.figi)
+                    self.wakeup.set()
+                    backoff = self._retry_sleep_min
+            except Exception as e:
+                if not stop.is_set():
+                    self.log("[WARN] orders stream dropped: %s", e)
+            finally:
+                # anything may have executed while disconnected: fall back to polling every figi
+                self._orders_stream_live = False
+
+            stop.wait(min(self._retry_sleep_max, backoff * random.uniform(0.5, 1.5)))
+            backoff = min(self._retry_sleep_max, backoff * 2)
+
+    def _order_poll_due(self, figi: str) -> bool:
+        with self._order_touched_lock:
+            touched = figi in self._order_touched
+            self._order_touched.discard(figi)
+        t = time.monotonic()
+        if touched or t - self._order_polled_at.get(figi, 0.0) >= self._order_reconcile_sec:
+            self._order_polled_at[figi] = t
+            return True
+        return False
+
     # ---------- order state polling ----------
     def poll_order_updates(self, account_id: str, figi: str):
         fs = self.state.get(figi)
         if not fs.active_order_id:
             return
+        if self._orders_stream_live and not self._order_poll_due(figi):
+            return
 
         oid = fs.active_order_id
         cuid = fs.client_order_uid or ""
 
         try:
-            st = self._call(self._order_state_call(), account_id=account_id, order_id=oid)
+            st = self._call(self._fn_order_state, account_id=account_id, order_id=oid)
         except Exception as e:
             if self._is_not_found_error(e):
                 self.log(f"[STATE] {self.format_instrument(figi)} order_id={oid} not found -> clearing local state")
@@ -784,29 +1422,27 @@ class Broker:
             self.log(f"[WARN] get_order_state failed {figi}: {e}")
             return
 
-        status = str(getattr(st, "execution_report_status", ""))
-        lots_requested = int(getattr(st, "lots_requested", 0) or 0)
-        lots_executed = int(getattr(st, "lots_executed", 0) or 0)
-        direction = str(getattr(st, "direction", ""))
-
-        avg_price = None
-        ap = getattr(st, "average_position_price", None)
-        if ap is not None:
-            try:
-                avg_price = float(self._to_float(ap))
-            except Exception:
-                avg_price = None
-
-        side = "BUY" if "BUY" in direction else ("SELL" if "SELL" in direction else str(getattr(fs, "order_side", "") or ""))
+        # compare SDK enum members, not str(): IntEnum.__str__ is just the number on py3.11+
+        # OrderState always carries these fields; only the price may be unset
+        status_enum = st.execution_report_status
+        status = status_enum.name
+        lots_executed = st.lots_executed or 0
+        direction = st.direction
 
-        final_statuses = {
-            "EXECUTION_REPORT_STATUS_FILL",
-            "EXECUTION_REPORT_STATUS_REJECTED",
-            "EXECUTION_REPORT_STATUS_CANCELLED",
-        }
-
-        if status in final_statuses:
-            if status == "EXECUTION_REPORT_STATUS_FILL":
+        try:
+            avg_price = _q_to_float(st.average_position_price)
+        except AttributeError:
+            avg_price = None
+
+        if direction == OrderDirection.ORDER_DIRECTION_BUY:
+            side = "BUY"
+        elif direction == OrderDirection.ORDER_DIRECTION_SELL:
+            side = "SELL"
+        else:
+            side = fs.order_side or ""
+
+        if status_enum in _FINAL_STATUSES:
+            if status_enum == OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_FILL:
                 self.journal_event(
                     "FILL",
                     figi,
@@ -831,19 +1467,18 @@ class Broker:
                     if fs.entry_time is None:
                         fs.entry_time = now()
                     if fs.entry_price is None and avg_price is not None:
-                        fs.entry_price = float(avg_price)
+                        fs.entry_price = avg_price
 
                 elif side == "SELL":
                     try:
                         entry = fs.entry_price
                         if entry is not None and avg_price is not None:
                             lot_size = self._lot_size(figi)
-                            qty_lots = float(lots_executed)
-                            pnl_abs = (float(avg_price) - float(entry)) * float(lot_size) * qty_lots
-                            pnl_pct = (float(avg_price) / float(entry) - 1.0) * 100.0
+                            pnl_abs = (avg_price - entry) * lot_size * lots_executed
+                            pnl_pct = (avg_price / entry - 1.0) * 100.0
                             self.notify(
                                 f"[PNL] {self._ticker_for_figi(figi) or figi} "
-                                f"{pnl_abs:+.2f} RUB ({pnl_pct:+.2f}%) | entry={float(entry):.4f} exit={float(avg_price):.4f}",
+                                f"{pnl_abs:+.2f} RUB ({pnl_pct:+.2f}%) | entry={entry:.4f} exit={avg_price:.4f}",
                                 throttle_sec=0,
                             )
                     except Exception:
@@ -852,7 +1487,7 @@ class Broker:
                     fs.entry_price = None
                     fs.entry_time = None
 
-            elif status == "EXECUTION_REPORT_STATUS_CANCELLED":
+            elif status_enum == OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_CANCELLED:
                 self.journal_event(
                     "CANCEL",
                     figi,
@@ -866,7 +1501,7 @@ class Broker:
                 )
                 self.notify(f"[CANCELLED] {self._ticker_for_figi(figi) or figi}", throttle_sec=0)
 
-            elif status == "EXECUTION_REPORT_STATUS_REJECTED":
+            elif status_enum == OrderExecutionReportStatus.EXECUTION_REPORT_STATUS_REJECTED:
                 self.journal_event(
                     "REJECT",
                     figi,
@@ -884,43 +1519,92 @@ class Broker:
             self._reserved_rub_by_figi.pop(figi, None)
 
     # ---------- flatten ----------
+    def _flatten_one(self, account_id: str, figi: str, fs, last: Optional[float]):
+        # a working close order is re-priced by place_limit_sell_to_close (replace / no-op)
+        if fs.active_order_id and not (fs.order_side == "SELL" and fs.position_lots > 0 and last is not None):
+            self.cancel_active_order(account_id, figi, reason="flatten_cancel")
+
+        if fs.position_lots > 0:
+            if last is None:
+                return
+            # last comes from flatten's bulk get_last_prices: no per-figi refetch
+            self.place_limit_sell_to_close(account_id, figi, price=last, last=last)
+
     def flatten_if_needed(self, account_id: str, schedule_cfg: dict):
         ts = now()
         if not self.flatten_due(ts, schedule_cfg):
             return
 
-        for figi in list(self.state.figi.keys()):
-            fs = self.state.get(figi)
+        with self.state_lock:
+            items = [(f, fs) for f, fs in list(self.state.figi.items()) if fs.active_order_id or fs.position_lots > 0]
+            if not items:
+                return
 
-            if fs.active_order_id:
-                self.cancel_active_order(account_id, figi, reason="flatten_cancel")
+            prices = self.get_last_prices_bulk([f for f, fs in items if fs.position_lots > 0])
 
-            if int(fs.position_lots) > 0:
-                last = self.get_last_price(figi)
-                if last is None:
-                    continue
-                self.place_limit_sell_to_close(account_id, figi, price=float(last))
+            # each FIGI only touches its own state -> cancel/sell in parallel
+            list(self._io_pool.map(lambda kv: self._flatten_one(account_id, kv[0], kv[1], prices.get(kv[0])), items))
 
     # ---------- day metric ----------
-    def calc_day_cashflow(self, account_id: str) -> float:
-        try:
-            tz = ZoneInfo("Europe/Moscow")
-            today_local = datetime.now(tz=tz).date()
+    def _day_window_utc(self) -> Tuple[datetime, datetime]:
+        tz = _MSK_TZ
+        today_local = datetime.now(tz=tz).date()
 
-            from_local = datetime.combine(today_local, datetime.min.time(), tzinfo=tz)
-            to_local = datetime.combine(today_local, datetime.max.time(), tzinfo=tz)
+        cached = self._pnl_window
+        if cached is not None and cached[0] == today_local:
+            return cached[1], cached[2]
 
-            from_utc = from_local.astimezone(ZoneInfo("UTC"))
-            to_utc = to_local.astimezone(ZoneInfo("UTC"))
+        from_local = datetime.combine(today_local, dt_time.min, tzinfo=tz)
+        to_local = datetime.combine(today_local, dt_time.max, tzinfo=tz)
 
-            ops = self._call(self._operations_call(), account_id=account_id, from_=from_utc, to=to_utc)
+        from_utc = from_local.astimezone(_UTC_TZ)
+        to_utc = to_local.astimezone(_UTC_TZ)
 
-            total = 0.0
-            for op in ops.operations:
-                if op.payment.currency == self.currency:
-                    total += float(self._to_float(op.payment))
+        self._pnl_window = (today_local, from_utc, to_utc)
+        return from_utc, to_utc
+
+    def calc_day_cashflow(self, account_id: str) -> float:
+        """
+        Running sum of today's executed payments. Each call only fetches ops since
+        the previous call (minus a small overlap for late-booked ops, deduped by id);
+        every cashflow_full_sec the whole day is re-read to pick up ops booked later still.
+        """
+        try:
+            from_utc, to_utc = self._day_window_utc()
+            if self._cf_day_from != from_utc:
+                self._cf_day_from = from_utc
+                self._cf_total = 0.0
+                self._cf_seen = set()
+                self._cf_cursor = from_utc
+
+            started = now()
+            full = time.monotonic() >= self._cf_full_due
+            # only executed ops (cancelled ones are dropped server-side)
+            ops = self._call(
+                self._fn_operations,
+                account_id=account_id,
+                from_=from_utc if full else max(from_utc, self._cf_cursor - _CASHFLOW_OVERLAP),
+                to=to_utc,
+                state=OperationState.OPERATION_STATE_EXECUTED,
+            )
 
-            return float(total)
+            cur = self.currency
+            seen = self._cf_seen
+            new = []
+            for op in ops.operations:
+                key = op.id or (op.date, op.type, op.payment.units, op.payment.nano)
+                if key in seen:
+                    continue
+                seen.add(key)
+                if op.payment.currency == cur:
+                    new.append(_q_to_float(op.payment))
+
+            self._cf_total += math.fsum(new)
+            self._cf_cursor = started
+            if full:
+                self._cf_full_due = time.monotonic() + self._cf_full_sec
+            return self._cf_total
         except Exception as e:
             self.log(f"[WARN] calc_day_cashflow failed: {e}")
-            return 0.0
+            # last known total: a failed fetch must not read as "flat day" to the risk lock
+            return self._cf_total
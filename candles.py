@@ -0,0 +1,102 @@
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+
+
+@dataclass(slots=True)
+class Candles:
+    """
+    1m-свечи одного FIGI в виде набора колонок (struct-of-arrays):
+    open/high/low/close/volume — float64 (VWAP: dot без приведения типов), time — tz-aware datetime (UTC).
+    Колонки — это view на буфер брокера, без копий.
+    """
+    time: List[datetime]
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.close)
+
+    def last_bar_key(self) -> tuple:
+        """Последняя свеча целиком: у незакрытой свечи high/low/volume меняются и при том же close."""
+        return self.time[-1], self.high[-1], self.low[-1], self.close[-1], self.volume[-1]
+
+    def tail(self, n: int) -> "Candles":
+        if n >= len(self.close):
+            return self
+        return Candles(
+            self.time[-n:],
+            self.open[-n:],
+            self.high[-n:],
+            self.low[-n:],
+            self.close[-n:],
+            self.volume[-n:],
+        )
+
+
+class CandleBuffer:
+    """
+    Последние 1m-свечи одного FIGI, которые дописывает поток market data.
+    Массивы на 2*cap строк: запись в хвост, при заполнении последние cap строк
+    сдвигаются в начало (амортизированно O(1)), хвост всегда непрерывный.
+    Незакрытая свеча (тот же time) перезаписывается на месте.
+    """
+    __slots__ = ("cap", "_n", "_time", "_ohlc", "_vol", "_lock")
+
+    def __init__(self, cap: int):
+        self.cap = cap
+        self._n = 0
+        self._time: List[Optional[datetime]] = [None] * (2 * cap)
+        self._ohlc = np.empty((4, 2 * cap))
+        self._vol = np.empty(2 * cap)
+        self._lock = threading.Lock()
+
+    def load(self, candles: Candles) -> None:
+        """Полная замена содержимого (первичная загрузка / догрузка пропуска после реконнекта)."""
+        c = candles.tail(self.cap)
+        n = len(c)
+        with self._lock:
+            self._time[:n] = c.time
+            self._ohlc[:, :n] = (c.open, c.high, c.low, c.close)
+            self._vol[:n] = c.volume
+            self._n = n
+
+    def update(self, t: datetime, o: float, h: float, l: float, c: float, v: float) -> bool:
+        """True, если началась новая свеча (т.е. предыдущая закрылась)."""
+        with self._lock:
+            n = self._n
+            last_t = self._time[n - 1] if n else None
+            if last_t is not None and t < last_t:
+                return False  # запоздавшее обновление уже закрытой свечи
+            new_bar = last_t is None or t != last_t
+            if not new_bar:
+                i = n - 1
+            else:
+                cap = self.cap
+                if n == 2 * cap:
+                    self._time[:cap] = self._time[cap:]
+                    self._ohlc[:, :cap] = self._ohlc[:, cap:]
+                    self._vol[:cap] = self._vol[cap:]
+                    n = cap
+                i = n
+                self._n = n + 1
+            self._time[i] = t
+            self._ohlc[:, i] = (o, h, l, c)
+            self._vol[i] = v
+            return new_bar
+
+    def snapshot(self) -> Optional[Candles]:
+        """Копия последних cap свечей: поток продолжает писать в буфер, стратегия читает свою копию."""
+        with self._lock:
+            n = self._n
+            if n == 0:
+                return None
+            lo = max(0, n - self.cap)
+            ohlc = self._ohlc[:, lo:n].copy()
+            return Candles(self._time[lo:n], ohlc[0], ohlc[1], ohlc[2], ohlc[3], self._vol[lo:n].copy())
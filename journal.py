@@ -1,7 +1,11 @@
+import atexit
 import csv
+import logging
 import os
+import threading
+from collections import deque
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Deque, List
 
 
 class TradeJournal:
@@ -12,6 +16,7 @@ class TradeJournal:
 
     def __init__(self, path: str = "logs/trades.csv"):
         self.path = path
+        self._lock = threading.Lock()
         os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
         self._ensure_header()
@@ -37,7 +42,7 @@ class TradeJournal:
                 "meta",
             ])
 
-    def write(
+    def _row(
         self,
         event: str,
         figi: str,
@@ -50,26 +55,90 @@ class TradeJournal:
         status: str = "",
         reason: str = "",
         meta: Optional[Dict[str, Any]] = None,
-    ):
+    ) -> List[Any]:
         ts = datetime.utcnow().isoformat()
         meta_str = ""
         if meta:
             # простая сериализация без json-зависимостей
             meta_str = ";".join([f"{k}={v}" for k, v in meta.items()])
 
-        with open(self.path, "a", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow([
-                ts,
-                event,
-                figi,
-                ticker,
-                side,
-                "" if lots is None else lots,
-                "" if price is None else f"{price:.6f}",
-                order_id,
-                client_uid,
-                status,
-                reason,
-                meta_str,
-            ])
+        return [
+            ts,
+            event,
+            figi,
+            ticker,
+            side,
+            "" if lots is None else lots,
+            "" if price is None else f"{price:.6f}",
+            order_id,
+            client_uid,
+            status,
+            reason,
+            meta_str,
+        ]
+
+    def _write_rows(self, rows: List[List[Any]]):
+        with self._lock, open(self.path, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(rows)
+
+    def write(self, event: str, figi: str, **kwargs):
+        self._write_rows([self._row(event, figi, **kwargs)])
+
+    def flush(self):
+        pass
+
+
+class BufferedJournal(TradeJournal):
+    """
+    Тот же API, что у TradeJournal, но write() только кладёт строку в память,
+    а в файл пишет фоновый поток пачками (раз в flush_sec или по max_rows).
+    ts строки берётся в момент write(), не в момент сброса.
+    """
+
+    def __init__(self, path: str = "logs/trades.csv", flush_sec: float = 1.0, max_rows: int = 50):
+        super().__init__(path)
+        self.flush_sec = float(flush_sec)
+        self.max_rows = max(1, int(max_rows))
+
+        self._buf: Deque[List[Any]] = deque()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="journal-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def write(self, event: str, figi: str, **kwargs):
+        self._buf.append(self._row(event, figi, **kwargs))
+        if len(self._buf) >= self.max_rows:
+            self._wake.set()
+
+    def flush(self):
+        # serialized so rows keep their order in the file
+        with self._flush_lock:
+            rows: List[List[Any]] = []
+            while self._buf:
+                rows.append(self._buf.popleft())
+            if rows:
+                try:
+                    self._write_rows(rows)
+                except Exception:
+                    # file locked / disk full: put the rows back in front, next flush retries them
+                    self._buf.extendleft(reversed(rows))
+                    raise
+
+    def _run(self):
+        failing = False  # log once per failure streak, not every flush_sec
+        while True:
+            self._wake.wait(self.flush_sec)
+            self._wake.clear()
+            try:
+                self.flush()
+                if failing:
+                    failing = False
+                    logging.getLogger("bot").info("[INFO] journal flush recovered")
+            except Exception as e:
+                # журнал не должен валить бота: строки остались в буфере, повторим на следующем сбросе
+                if not failing:
+                    failing = True
+                    logging.getLogger("bot").warning("[WARN] journal flush failed (%d rows kept): %s", len(self._buf), e)
@@ -1,7 +1,8 @@
 import os
 import time
+import threading
 import yaml
-from datetime import datetime, timezone
+from datetime import date
 
 from tinkoff.invest import Client
 from tinkoff.invest.utils import now
@@ -30,6 +31,57 @@ def get_token() -> str:
     return token
 
 
+def grpc_channel_options(cfg: dict) -> list:
+    """
+    Opt-in HTTP/2 keepalive pings: keep the channel (and NAT/LB state) warm across the
+    sleep between loops, so calls don't pay a reconnect + TLS handshake.
+    Off by default: pings more often than the server allows get the connection dropped
+    (GOAWAY too_many_pings), together with the market data / orders streams.
+    """
+    keepalive_ms = int(cfg.get("grpc_keepalive_ms", 0))
+    if keepalive_ms <= 0:
+        return []
+    return [
+        ("grpc.keepalive_time_ms", keepalive_ms),
+        ("grpc.keepalive_timeout_ms", int(cfg.get("grpc_keepalive_timeout_ms", 10000))),
+        ("grpc.keepalive_permit_without_calls", int(bool(cfg.get("grpc_keepalive_permit_without_calls", False)))),
+    ]
+
+
+def send_daily_report(broker, notifier, account_id: str, figis: list, trades_csv: str, day: date) -> bool:
+    """End-of-day report + end portfolio. True once the report went out."""
+    try:
+        broker.journal.flush()
+        df = load_trades(trades_csv)
+        report = build_report(df, day)
+        broker.log(report)
+        notifier.send(report, throttle_sec=0)
+
+        try:
+            txt = broker.build_portfolio_status(account_id, figis, title="Portfolio snapshot (end)")
+            broker.log(txt)
+            notifier.send(txt, throttle_sec=0)
+        except Exception as e:
+            broker.log(f"[WARN] Portfolio snapshot failed (end): {e}")
+
+        return True
+    except Exception as e:
+        broker.log(f"[WARN] Daily report generation failed: {e}")
+        return False
+
+
+def wait_for_wakeup(event: threading.Event, timeout: float):
+    """
+    Sleep up to timeout, return early once a stream sets the event.
+    Waits in 1s slices: a long blocking wait isn't interrupted by Ctrl+C on Windows.
+    """
+    deadline = time.monotonic() + timeout
+    while (left := deadline - time.monotonic()) > 0:
+        if event.wait(min(1.0, left)):
+            break
+    event.clear()
+
+
 def main():
     cfg = load_config()
     token = get_token()
@@ -47,7 +99,19 @@ def main():
     # NEW: order TTL seconds (cancel if not filled)
     order_ttl_sec = int(cfg.get("runtime", {}).get("order_ttl_sec", 120))  # 2 minutes default
 
-    with Client(token) as client:
+    # positions/orders sync off the loop (0 = inline snapshot every loop),
+    # day PnL / loss-lock check cadence (0 = every loop, as before)
+    state_sync_sec = float(cfg.get("runtime", {}).get("state_sync_sec", 0))
+    day_pnl_sec = float(cfg.get("runtime", {}).get("day_pnl_sec", 0))
+    max_consecutive_errors = int(cfg.get("runtime", {}).get("max_consecutive_errors", 8))
+
+    # read once: the loop below runs all day
+    schedule_cfg = cfg["schedule"]
+    lookback_minutes = cfg["strategy"]["lookback_minutes"]
+    trades_csv = cfg["broker"].get("trades_csv", "logs/trades.csv")
+    currency_upper = cfg["broker"].get("currency", "rub").upper()
+
+    with Client(token, options=grpc_channel_options(cfg["broker"])) as client:
         broker = Broker(client, cfg["broker"], notifier=notifier)
 
         account_id = broker.pick_account_id()
@@ -78,80 +142,66 @@ def main():
         except Exception as e:
             broker.log(f"[WARN] Portfolio snapshot failed (start): {e}")
 
-        last_hb = 0.0
-        last_portfolio_push = 0.0
+        # push-based 1m candles instead of polling get_candles every loop
+        if cfg["broker"].get("candles_stream", False):
+            broker.start_candle_stream(figis, lookback_minutes=lookback_minutes)
+
+        # fills pushed by TradesStream; poll_order_updates then only polls touched figis
+        if cfg["broker"].get("orders_stream", False):
+            broker.start_orders_stream(account_id)
+
+        if state_sync_sec > 0:
+            broker.start_background_sync(account_id, figis, interval_sec=state_sync_sec)
+
+        # monotonic deadlines: immune to wall-clock jumps, one compare per check
+        next_hb = next_portfolio_push = next_day_pnl = time.monotonic()
         consecutive_errors = 0
-        report_sent_for_day: str | None = None
+        report_sent_for_day: date | None = None
 
         while True:
             try:
                 ts = now()
 
                 # Heartbeat
-                if time.time() - last_hb >= heartbeat_sec:
+                tick = time.monotonic()
+                if tick >= next_hb:
                     broker.log(f"[HB] alive | utc={ts.isoformat()}")
-                    last_hb = time.time()
+                    next_hb = tick + heartbeat_sec
 
                 # Portfolio snapshot every N seconds
-                if time.time() - last_portfolio_push >= portfolio_sec:
+                if tick >= next_portfolio_push:
                     try:
                         txt = broker.build_portfolio_status(account_id, figis, title="Portfolio snapshot")
                         broker.log(txt)
                         notifier.send(txt, throttle_sec=0)
                     except Exception as e:
                         broker.log(f"[WARN] Portfolio snapshot failed: {e}")
-                    last_portfolio_push = time.time()
+                    next_portfolio_push = time.monotonic() + portfolio_sec
 
                 # Outside trading window
-                if not broker.is_trading_time(ts, cfg["schedule"]):
-                    broker.flatten_if_needed(account_id, cfg["schedule"])
+                if not broker.is_trading_time(ts, schedule_cfg):
+                    broker.flatten_if_needed(account_id, schedule_cfg)
 
                     # End of day report + end portfolio
-                    if broker.flatten_due(ts, cfg["schedule"]):
-                        day_key = datetime.now(timezone.utc).date().isoformat()
-                        if report_sent_for_day != day_key:
-                            try:
-                                df = load_trades(cfg["broker"].get("trades_csv", "logs/trades.csv"))
-                                report = build_report(df, datetime.now(timezone.utc).date())
-                                broker.log(report)
-                                notifier.send(report, throttle_sec=0)
-
-                                try:
-                                    txt = broker.build_portfolio_status(account_id, figis, title="Portfolio snapshot (end)")
-                                    broker.log(txt)
-                                    notifier.send(txt, throttle_sec=0)
-                                except Exception as e:
-                                    broker.log(f"[WARN] Portfolio snapshot failed (end): {e}")
-
-                                report_sent_for_day = day_key
-                            except Exception as e:
-                                broker.log(f"[WARN] Daily report generation failed: {e}")
+                    if broker.flatten_due(ts, schedule_cfg):
+                        day = ts.date()
+                        if report_sent_for_day != day and send_daily_report(
+                            broker, notifier, account_id, figis, trades_csv, day
+                        ):
+                            report_sent_for_day = day
 
                     time.sleep(min(10, sleep_sec))
                     continue
 
                 # Flatten time
-                if broker.flatten_due(ts, cfg["schedule"]):
-                    broker.flatten_if_needed(account_id, cfg["schedule"])
-
-                    day_key = datetime.now(timezone.utc).date().isoformat()
-                    if report_sent_for_day != day_key:
-                        try:
-                            df = load_trades(cfg["broker"].get("trades_csv", "logs/trades.csv"))
-                            report = build_report(df, datetime.now(timezone.utc).date())
-                            broker.log(report)
-                            notifier.send(report, throttle_sec=0)
-
-                            try:
-                                txt = broker.build_portfolio_status(account_id, figis, title="Portfolio snapshot (end)")
-                                broker.log(txt)
-                                notifier.send(txt, throttle_sec=0)
-                            except Exception as e:
-                                broker.log(f"[WARN] Portfolio snapshot failed (end): {e}")
-
-                            report_sent_for_day = day_key
-                        except Exception as e:
-                            broker.log(f"[WARN] Daily report generation failed: {e}")
+                if broker.flatten_due(ts, schedule_cfg):
+                    broker.flatten_if_needed(account_id, schedule_cfg)
+
+                    day = ts.date()
+                    if report_sent_for_day != day and send_daily_report(
+                        broker, notifier, account_id, figis, trades_csv, day
+                    ):
+                        report_sent_for_day = day
 
                     time.sleep(min(10, sleep_sec))
                     continue
@@ -161,78 +211,109 @@ def main():
                     time.sleep(30)
                     continue
 
-                entries_allowed = broker.new_entries_allowed(ts, cfg["schedule"])
-
-                # Snapshot once per loop
-                broker.refresh_account_snapshot(account_id, figis)
-
-                for figi in figis:
-                    # 0) expire stale orders first (free slots, keep bot "simple flow")
-                    broker.expire_stale_orders(account_id, figi, ttl_sec=order_ttl_sec)
-
-                    # 1) order status updates
-                    broker.poll_order_updates(account_id, figi)
-
-                    # candles
-                    candles = broker.get_last_candles_1m(figi, lookback_minutes=cfg["strategy"]["lookback_minutes"])
-                    if candles is None or len(candles) < 30:
-                        continue
-
-                    # signal
-                    signal = strategy.make_signal(figi, candles, broker.state)
-                    action = signal.get("action", "HOLD")
-
-                    # journal signals
-                    if action in ("BUY", "SELL"):
-                        price = signal.get("price")
-                        limit_price = signal.get("limit_price", price)
-                        reason = signal.get("reason", "")
-                        inst = broker.format_instrument(figi)
-
-                        cash = broker.get_cached_cash_rub(account_id)
-                        try:
-                            free = broker.get_free_cash_rub_estimate(account_id)
-                        except Exception:
-                            free = cash
-
-                        broker.log(
-                            f"[SIGNAL] {action} {inst} last={price} limit={float(limit_price):.4f} "
-                            f"| cash≈{cash:.2f} free≈{free:.2f} RUB | {reason}"
-                        )
-
-                        broker.journal_event(
-                            "SIGNAL",
-                            figi,
-                            side=action,
-                            lots=1,
-                            price=price,
-                            reason=reason,
-                            meta={"limit_price": float(limit_price) if limit_price is not None else None},
-                        )
-
-                    # execute (simple loop: signal -> order now)
-                    if action == "BUY":
-                        if not entries_allowed:
-                            continue
-                        if not risk.allow_new_trade(broker.state, account_id, figi):
-                            continue
-                        broker.place_limit_buy(account_id, figi, signal.get("limit_price", signal["price"]))
-
-                    elif action == "SELL":
-                        broker.place_limit_sell_to_close(account_id, figi, signal.get("limit_price", signal["price"]))
+                entries_allowed = broker.new_entries_allowed(ts, schedule_cfg)
+
+                # Snapshot once per loop + candles for all figis, fetched concurrently
+                candles_by_figi = broker.refresh_snapshot_and_candles(
+                    account_id, figis, lookback_minutes=lookback_minutes
+                )
+                # ATR/VWAP in one stacked numpy pass; figis whose last bar is unchanged come from the strategy's cache
+                indicators = strategy.precompute_batch(
+                    {f: c for f, c in candles_by_figi.items() if c is not None and len(c) >= 30}
+                )
+
+                # state_lock: background sync must not apply a snapshot mid-pass
+                with broker.state_lock:
+                    # orders are queued per figi and posted together (concurrently) at the end of the pass
+                    try:
+                        for figi in figis:
+                            # 0) expire stale orders first (free slots, keep bot "simple flow")
+                            broker.expire_stale_orders(account_id, figi, ttl_sec=order_ttl_sec)
+
+                            # 1) order status updates
+                            broker.poll_order_updates(account_id, figi)
+
+                            # candles
+                            candles = candles_by_figi.get(figi)
+                            if candles is None or len(candles) < 30:
+                                continue
+
+                            # same last bar (incl. high/low/volume of a forming bar) and same position/order
+                            # as the last HOLD -> HOLD again
+                            fs = broker.state.get(figi)
+                            key = (candles.last_bar_key(), fs.position_lots, fs.active_order_id)
+                            if key == fs.last_signal_key:
+                                continue
+
+                            # signal
+                            signal = strategy.make_signal(figi, candles, broker.state, indicators.get(figi))
+                            action = signal.get("action", "HOLD")
+
+                            # only HOLD is memoized: a BUY/SELL that was blocked or failed to post
+                            # must be re-evaluated next pass even on the same bar
+                            fs.last_signal_key = key if action == "HOLD" else None
+
+                            # journal signals
+                            if action in ("BUY", "SELL"):
+                                price = signal.get("price")
+                                limit_price = signal.get("limit_price", price)
+                                reason = signal.get("reason", "")
+                                inst = broker.format_instrument(figi)
+
+                                cash = broker.get_cached_cash_rub(account_id)
+                                try:
+                                    free = broker.get_free_cash_rub_estimate(account_id)
+                                except Exception:
+                                    free = cash
+
+                                broker.log(
+                                    f"[SIGNAL] {action} {inst} last={price} limit={float(limit_price):.4f} "
+                                    f"| cash≈{cash:.2f} free≈{free:.2f} {currency_upper} | {reason}"
+                                )
+
+                                broker.journal_event(
+                                    "SIGNAL",
+                                    figi,
+                                    side=action,
+                                    lots=1,
+                                    price=price,
+                                    reason=reason,
+                                    meta={"limit_price": float(limit_price) if limit_price is not None else None},
+                                )
+
+                            # execute: order is queued now, posted with the rest after the loop
+                            if action == "BUY":
+                                if not entries_allowed:
+                                    continue
+                                if not risk.allow_new_trade(broker.state, account_id, figi):
+                                    continue
+                                broker.queue_limit_buy(account_id, figi, signal.get("limit_price", signal["price"]))
+
+                            elif action == "SELL":
+                                broker.queue_limit_sell_to_close(account_id, figi, signal.get("limit_price", signal["price"]))
+                    except KeyboardInterrupt:
+                        # Ctrl+C: the handler below flattens, new orders must not go out first
+                        broker.discard_queued_orders()
+                        raise
+                    except Exception:
+                        broker.submit_queued_orders(account_id)
+                        raise
+                    broker.submit_queued_orders(account_id)
 
                 # day protector
-                day_metric = broker.calc_day_cashflow(account_id)
-                risk.update_day_pnl(day_metric)
+                if time.monotonic() >= next_day_pnl:
+                    day_metric = broker.calc_day_cashflow(account_id)
+                    risk.update_day_pnl(day_metric)
+                    next_day_pnl = time.monotonic() + day_pnl_sec
 
-                time.sleep(sleep_sec)
+                wait_for_wakeup(broker.wakeup, sleep_sec)
                 consecutive_errors = 0
 
             except KeyboardInterrupt:
                 broker.log("[INFO] Stopped by user (Ctrl+C). Trying to flatten...")
                 notifier.send("trade_bot stopped by user (Ctrl+C). Flattening...", throttle_sec=0)
                 try:
-                    broker.flatten_if_needed(account_id, cfg["schedule"])
+                    broker.flatten_if_needed(account_id, schedule_cfg)
                 except Exception as e:
                     broker.log(f"[WARN] Flatten on exit failed: {e}")
                 break
@@ -246,12 +327,16 @@ def main():
                 consecutive_errors += 1
                 notifier.send(f"[ERROR] Main loop error: {e}", throttle_sec=120)
 
-                if consecutive_errors >= int(cfg.get("runtime", {}).get("max_consecutive_errors", 8)):
+                if consecutive_errors >= max_consecutive_errors:
                     broker.log("[ERROR] Too many consecutive errors. Stopping bot.")
                     notifier.send("[FATAL] Too many consecutive errors. Stopping bot.", throttle_sec=0)
                     break
                 time.sleep(error_sleep_sec)
 
+        broker.stop_candle_stream()
+        broker.stop_background_sync()
+        broker.stop_orders_stream()
+
 
 if __name__ == "__main__":
     main()
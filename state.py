@@ -1,9 +1,11 @@
+import threading
+from collections import defaultdict
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional, Dict
+from typing import Any, Optional, Dict, Tuple
 
 
-@dataclass
+@dataclass(slots=True)
 class FigiState:
     active_order_id: Optional[str] = None       # биржевой order_id (ответ API)
     client_order_uid: Optional[str] = None      # наш idempotency key
@@ -11,6 +13,7 @@ class FigiState:
     # NEW: чтобы понимать что за ордер висит и когда поставили (TTL)
     order_side: Optional[str] = None            # "BUY" / "SELL"
     order_placed_ts: Optional[datetime] = None  # when order was placed (UTC)
+    order_price: Optional[float] = None         # limit price we posted (for replace / no-op re-quotes)
 
     # position_lots хранится в ЛОТАХ (не в штуках)
     position_lots: int = 0
@@ -19,16 +22,29 @@ class FigiState:
     entry_price: Optional[float] = None
     entry_time: Optional[datetime] = None
 
+    # (Candles.last_bar_key(), position_lots, active_order_id) of the last HOLD;
+    # same key -> same signal, main skips the re-evaluation
+    last_signal_key: Optional[Tuple[Any, ...]] = None
 
-@dataclass
+
+@dataclass(slots=True)
 class BotState:
-    figi: Dict[str, FigiState] = field(default_factory=dict)
+    # defaultdict: get() is a single lookup; read-only predicates use .get() to avoid creating entries
+    figi: Dict[str, FigiState] = field(default_factory=lambda: defaultdict(FigiState))
     trades_today: int = 0
     current_day: Optional[str] = None  # YYYY-MM-DD (UTC)
+    # bumped on every local order change; a background snapshot is applied only if it didn't move
+    local_epoch: int = 0
+
+    # O(1) portfolio counters for RiskManager; kept in sync by set_position_lots / set_active_order
+    # (position_lots / active_order_id must not be assigned directly)
+    _n_open_positions: int = 0
+    _n_active_orders: int = 0
+    _n_pending_buys: int = 0
+    # counters are updated from flatten workers on the io pool too, += isn't atomic
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
     def get(self, figi: str) -> FigiState:
-        if figi not in self.figi:
-            self.figi[figi] = FigiState()
         return self.figi[figi]
 
     def has_open_position(self, figi: str) -> bool:
@@ -40,7 +56,40 @@ class BotState:
         return bool(fs and fs.active_order_id)
 
     def open_positions_count(self) -> int:
-        return sum(1 for fs in self.figi.values() if int(fs.position_lots) > 0)
+        return self._n_open_positions
+
+    def active_orders_count(self) -> int:
+        return self._n_active_orders
+
+    def pending_buys_count(self) -> int:
+        # conservative: any working order on a figi WITHOUT position counts as a pending BUY
+        return self._n_pending_buys
+
+    def _count(self, fs: FigiState, sign: int):
+        has_pos = fs.position_lots > 0
+        has_order = bool(fs.active_order_id)
+        self._n_open_positions += sign * has_pos
+        self._n_active_orders += sign * has_order
+        self._n_pending_buys += sign * (has_order and not has_pos)
+
+    def set_position_lots(self, figi: str, lots: int):
+        fs = self.get(figi)
+        with self._lock:
+            if fs.position_lots == lots:
+                return
+            self._count(fs, -1)
+            fs.position_lots = lots
+            self._count(fs, 1)
+
+    def set_active_order(self, figi: str, order_id: Optional[str]):
+        fs = self.get(figi)
+        with self._lock:
+            self.local_epoch += 1
+            if fs.active_order_id == order_id:
+                return
+            self._count(fs, -1)
+            fs.active_order_id = order_id
+            self._count(fs, 1)
 
     def clear_entry(self, figi: str):
         fs = self.get(figi)
@@ -49,11 +98,12 @@ class BotState:
 
     # NEW: clearing order meta in one place
     def clear_order(self, figi: str):
+        self.set_active_order(figi, None)
         fs = self.get(figi)
-        fs.active_order_id = None
         fs.client_order_uid = None
         fs.order_side = None
         fs.order_placed_ts = None
+        fs.order_price = None
 
     def reset_day(self, day_key: str):
         self.current_day = day_key
@@ -1,6 +1,68 @@
 import numpy as np
-import pandas as pd
-from datetime import timedelta
+from dataclasses import dataclass
+from functools import lru_cache
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from candles import Candles
+
+
+def _atr_last(high: np.ndarray, low: np.ndarray, close: np.ndarray, n: int = 14) -> float:
+    """
+    SMA of the last n true ranges (== rolling(n).mean().iloc[-1] over the full TR series).
+    Only the last n bars and their previous closes are touched: no Series, no full-length TR.
+    """
+    if len(close) < n + 1:
+        return float("nan")
+    h = high[-n:]
+    l = low[-n:]
+    pc = close[-n - 1:-1]
+    tr = np.maximum(h - l, np.maximum(np.abs(h - pc), np.abs(l - pc)))
+    return float(tr.mean())
+
+
+@dataclass(slots=True, frozen=True)
+class Indicators:
+    """Per-bar inputs of make_signal, computed once by Strategy.precompute()."""
+    last: float
+    last_time: datetime
+    atr: float
+    vwap: float
+
+
+@dataclass(slots=True, frozen=True)
+class _Reason:
+    """HOLD reason with numbers, formatted only when str()'d (logged) — most HOLDs are never read."""
+    fmt: str
+    args: tuple
+
+    def __str__(self) -> str:
+        return self.fmt.format(*self.args)
+
+
+@lru_cache(maxsize=8)
+def _ewm_weights(n: int, m: int) -> np.ndarray:
+    """
+    Weights w with dot(w, x[-m:]) == ewm(alpha=1/n, adjust=False).mean().iloc[-1] over m values:
+    alpha*(1-alpha)^(m-1-k) for k >= 1, the seed x[0] keeps (1-alpha)^(m-1).
+    """
+    a = 1.0 / n
+    w = a * (1.0 - a) ** np.arange(m - 1, -1, -1, dtype=np.float64)
+    w[0] = (1.0 - a) ** (m - 1)
+    w.setflags(write=False)
+    return w
+
+
+def _atr_wilder(high: np.ndarray, low: np.ndarray, close: np.ndarray, n: int = 14) -> float:
+    """Wilder's ATR (EWM of TR, alpha=1/n) over the window as one dot product; no per-figi state."""
+    m = len(close)
+    if m < n + 1:
+        return float("nan")
+    tr = high - low
+    hl = tr[1:]
+    np.maximum(hl, np.abs(high[1:] - close[:-1]), out=hl)
+    np.maximum(hl, np.abs(low[1:] - close[:-1]), out=hl)
+    return float(np.dot(_ewm_weights(n, m), tr))
 
 
 class Strategy:
@@ -11,6 +73,10 @@ class Strategy:
         self.lookback = int(cfg.get("lookback_minutes", 180))
         self.time_stop_minutes = int(cfg.get("time_stop_minutes", 45))
 
+        # "sma" — SMA of the last 14 TR (as before); "wilder" — Wilder's smoothing (EWM, alpha=1/14)
+        self.atr_method = str(cfg.get("atr_method", "sma")).lower()
+        self._atr_fn = _atr_wilder if self.atr_method == "wilder" else _atr_last
+
         # Existing entry filters (from earlier improved version)
         self.min_edge_atr = float(cfg.get("min_edge_atr", 0.05))
         self.max_rebound_atr = float(cfg.get("max_rebound_atr", 0.25))
@@ -31,44 +97,99 @@ class Strategy:
         # Require safe-exit only if time-stop already reached
         self.enable_time_stop_safe_exit = bool(cfg.get("enable_time_stop_safe_exit", True))
 
-    @staticmethod
-    def _atr(df: pd.DataFrame, n: int = 14) -> float:
-        high = df["high"].values
-        low = df["low"].values
-        close = df["close"].values
-        prev_close = np.r_[close[0], close[:-1]]
-        tr = np.maximum(
-            high - low,
-            np.maximum(np.abs(high - prev_close), np.abs(low - prev_close)),
-        )
-        if len(tr) < n + 1:
-            return float("nan")
-        return float(pd.Series(tr).rolling(n).mean().iloc[-1])
+        # per-call constants of make_signal, built once
+        self._time_stop_td = timedelta(minutes=self.time_stop_minutes)
+        self._one_plus_take = 1 + self.take_pct
+        self._one_minus_stop = 1 - self.stop_pct
+        self._one_minus_tight_stop = 1 - self.time_stop_tighten_stop_loss_pct
+        self._one_plus_breakeven = 1 + self.breakeven_pct
+
+        # figi -> (Candles.last_bar_key(), Indicators): precompute_batch() reuses them while the last bar is unchanged
+        self._ind_cache: Dict[str, Tuple[tuple, Indicators]] = {}
+
+    def _atr(self, df: Candles, n: int = 14) -> float:
+        return self._atr_fn(df.high, df.low, df.close, n)
 
     @staticmethod
-    def _vwap(df: pd.DataFrame) -> float:
-        pv = (df["close"] * df["volume"]).sum()
-        vv = df["volume"].sum()
+    def _vwap(df: Candles) -> float:
+        pv = np.dot(df.close, df.volume)
+        vv = df.volume.sum()
         if vv <= 0:
-            return float(df["close"].iloc[-1])
+            return float(df.close[-1])
         return float(pv / vv)
 
-    def make_signal(self, figi: str, candles: pd.DataFrame, state) -> dict:
+    def precompute(self, candles: Candles) -> Indicators:
+        """ATR/VWAP/last of the lookback window; reusable by any caller holding the same bar."""
+        df = candles.tail(self.lookback)
+        return Indicators(float(df.close[-1]), df.time[-1], self._atr(df, 14), self._vwap(df))
+
+    def precompute_batch(self, candles_by_figi: Dict[str, Candles], n: int = 14) -> Dict[str, Indicators]:
+        """
+        precompute() for many figis at once: full lookback windows are stacked into (N, lookback)
+        arrays and TR/ATR/VWAP are reduced along axis=1. Shorter (warming up) windows go one by one.
+        A figi whose last bar (time, high, low, close, volume) is unchanged gets the cached Indicators back.
+        """
+        out: Dict[str, Indicators] = {}
+        full = []
+        cache = self._ind_cache
+        for figi, c in candles_by_figi.items():
+            if c is None or len(c) == 0:
+                continue
+            bar = c.last_bar_key()
+            hit = cache.get(figi)
+            if hit is not None and hit[0] == bar:
+                out[figi] = hit[1]
+            elif len(c) >= self.lookback:
+                full.append((figi, c.tail(self.lookback)))
+            else:
+                out[figi] = self.precompute(c)
+                cache[figi] = (bar, out[figi])
+        if not full:
+            return out
+
+        high = np.stack([c.high for _, c in full])
+        low = np.stack([c.low for _, c in full])
+        close = np.stack([c.close for _, c in full])
+        volume = np.stack([c.volume for _, c in full])
+
+        m = close.shape[1]
+        if m < n + 1:
+            atr = np.full(len(full), np.nan)
+        else:
+            # tr[:, 0] is the first bar's high-low (no previous close), as in _atr_wilder
+            tr = high - low
+            pc = close[:, :-1]
+            np.maximum.reduce([tr[:, 1:], np.abs(high[:, 1:] - pc), np.abs(low[:, 1:] - pc)], out=tr[:, 1:])
+            atr = tr @ _ewm_weights(n, m) if self._atr_fn is _atr_wilder else tr[:, -n:].mean(axis=1)
+
+        pv = np.einsum("ij,ij->i", close, volume)
+        vv = volume.sum(axis=1)
+        last = close[:, -1]
+        vwap = np.where(vv > 0, pv / np.where(vv > 0, vv, 1), last)
+
+        for i, (figi, c) in enumerate(full):
+            out[figi] = Indicators(float(last[i]), c.time[-1], float(atr[i]), float(vwap[i]))
+            cache[figi] = (c.last_bar_key(), out[figi])
+        return out
+
+    def make_signal(self, figi: str, candles: Candles, state, ind: Optional[Indicators] = None) -> dict:
         """
         Returns dict like:
           - action: BUY/SELL/HOLD
           - price: last close (for reporting)
           - limit_price: recommended LIMIT price (for BUY/SELL)
-          - reason: string
+          - reason: string (HOLD: str() of the value, formatted lazily)
+        `ind` — indicators already computed for this bar (precompute()); computed here if omitted.
         """
-        df = candles.tail(self.lookback).copy()
-        last = float(df["close"].iloc[-1])
+        if ind is None:
+            ind = self.precompute(candles)
+        last = ind.last
 
-        atr = self._atr(df, 14)
+        atr = ind.atr
         if not np.isfinite(atr) or atr <= 0:
             return {"action": "HOLD", "price": last, "reason": "ATR not ready"}
 
-        vwap = self._vwap(df)
+        vwap = ind.vwap
         fs = state.get(figi)
         has_pos = int(getattr(fs, "position_lots", 0) or 0) > 0
         has_active_order = bool(getattr(fs, "active_order_id", None))
@@ -85,13 +206,13 @@ class Strategy:
             if fs.entry_price is None:
                 fs.entry_price = last
             if fs.entry_time is None:
-                fs.entry_time = df["time"].iloc[-1]
+                fs.entry_time = ind.last_time
 
             entry = float(fs.entry_price)
 
             # Base levels
-            take_level = max(entry * (1 + self.take_pct), vwap)
-            stop_level = entry * (1 - self.stop_pct)
+            take_level = max(entry * self._one_plus_take, vwap)
+            stop_level = entry * self._one_minus_stop
 
             # Time-based behavior change (Variant A):
             # After time_stop_minutes:
@@ -99,17 +220,17 @@ class Strategy:
             # - allow safe-exit at VWAP / breakeven (optional)
             age = None
             if fs.entry_time is not None:
-                age = df["time"].iloc[-1] - fs.entry_time
+                age = ind.last_time - fs.entry_time
 
-            time_mode_on = bool(age is not None and age >= timedelta(minutes=self.time_stop_minutes))
+            time_mode_on = bool(age is not None and age >= self._time_stop_td)
 
             if time_mode_on:
-                tightened_stop = entry * (1 - float(self.time_stop_tighten_stop_loss_pct))
+                tightened_stop = entry * self._one_minus_tight_stop
                 # Tighten = move stop UP (towards entry), i.e. reduce allowed loss
                 stop_level = max(stop_level, tightened_stop)
 
                 if self.enable_time_stop_safe_exit:
-                    breakeven_level = entry * (1 + float(self.breakeven_pct))
+                    breakeven_level = entry * self._one_plus_breakeven
                     safe_exit_level = max(vwap, breakeven_level)
 
                     # If price returned to VWAP / breakeven after long hold -> exit safely
@@ -141,7 +262,7 @@ class Strategy:
                 }
 
             if time_mode_on:
-                return {"action": "HOLD", "price": last, "reason": f"in_position_time_mode age={age}"}
+                return {"action": "HOLD", "price": last, "reason": _Reason("in_position_time_mode age={}", (age,))}
 
             return {"action": "HOLD", "price": last, "reason": "in_position"}
 
@@ -155,7 +276,7 @@ class Strategy:
 
         # If signal is too shallow -> skip (noise)
         if edge_atr < self.min_edge_atr:
-            return {"action": "HOLD", "price": last, "reason": f"no_edge edge_atr={edge_atr:.3f}"}
+            return {"action": "HOLD", "price": last, "reason": _Reason("no_edge edge_atr={:.3f}", (edge_atr,))}
 
         if last < buy_level:
             # Recommended LIMIT at buy_level (not at last)
@@ -164,7 +285,7 @@ class Strategy:
             # If price already rebounded too far above buy_level, don't chase
             rebound_atr = float((last - buy_level) / atr)
             if rebound_atr > self.max_rebound_atr:
-                return {"action": "HOLD", "price": last, "reason": f"skip_chase rebound_atr={rebound_atr:.3f}"}
+                return {"action": "HOLD", "price": last, "reason": _Reason("skip_chase rebound_atr={:.3f}", (rebound_atr,))}
 
             return {
                 "action": "BUY",